@@ -3,18 +3,43 @@ import asyncio, os, websockets
 from dataclasses import dataclass
 from typing import Any, Literal, Optional, Dict, List
 from dotenv import load_dotenv
-from langgraph.graph import StateGraph, START, END
-from llm_module import LLMManager
+from llm_module import LLMManager, LLM_PROVIDER
 import time
-import json
+import orjson
 from mqtt_tools import tools, execute_tool, init_mqtt
 import re
 import hashlib
+import logging
+import logging.handlers
+import queue
+import atexit
+import functools
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+import io
+import wave
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from cachetools import LRUCache, TTLCache
 
 # Импортируем оптимизированную систему парсинга
 from improved_tool_parser import OptimizedToolParser, ToolCall
 
 load_dotenv()
+
+# Логирование: сообщения форматируются только если уровень включен,
+# а запись в stdout идет из фонового потока и не блокирует event loop
+log = logging.getLogger("agent")
+log.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+log.propagate = False
+_log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 init_mqtt()
 
 # Создаем глобальный экземпляр парсера
@@ -24,25 +49,61 @@ tool_parser = OptimizedToolParser()
 PERFORMANCE_MODE = os.getenv("PERFORMANCE_MODE", "balanced").lower()  # fast, balanced, accurate
 USE_LLM_FALLBACK = os.getenv("USE_LLM_FALLBACK", "true").lower() == "true"
 CONFIDENCE_THRESHOLD = float(os.getenv("CONFIDENCE_THRESHOLD", "0.4"))
+# Синтез речи по предложениям параллельно с генерацией LLM
+STREAM_TTS = os.getenv("STREAM_TTS", "true").lower() == "true"
 
 # Устанавливаем порог уверенности
 tool_parser.set_confidence_threshold(CONFIDENCE_THRESHOLD)
 
+# Замеры текущего высказывания. Свой список у каждой задачи-обработчика, дочерние задачи видят его же
+_turn_spans: ContextVar[Optional[list]] = ContextVar("turn_spans", default=None)
+
 class PerformanceMonitor:
     def __init__(self):
-        self.timings = {}
-        self.enabled = os.getenv("PERF_MONITOR", "true").lower() == "true"
+        # Флаг читается один раз при импорте; замеры не нужны, если INFO-сообщения все равно отфильтрованы
+        self.enabled = os.getenv("PERF_MONITOR", "true").lower() == "true" and log.isEnabledFor(logging.INFO)
         self.stats = {"total_requests": 0, "tool_calls": 0, "llm_calls": 0, "direct_parse": 0}
+        if not self.enabled:
+            # Выключенный мониторинг: span сразу пустой контекст, без генератора и проверки флага
+            self.span = lambda phase: nullcontext()
+            self.turn = nullcontext
+    
+    @contextmanager
+    def span(self, phase: str):
+        """Замер одного участка. Время хранится в локальной переменной, поэтому параллельные запросы не мешают друг другу"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            spans = _turn_spans.get()
+            if spans is None:
+                log.info("[PERF] %s: %.2fs", phase, time.perf_counter() - t0)
+            else:
+                spans.append((phase, time.perf_counter() - t0))
     
-    def start(self, phase: str):
-        if self.enabled:
-            self.timings[f"{phase}_start"] = time.perf_counter()
+    @contextmanager
+    def turn(self):
+        """Собирает замеры узлов за одно высказывание и выводит их одной строкой в конце"""
+        spans = []
+        token = _turn_spans.set(spans)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            _turn_spans.reset(token)
+            log.info("[PERF] %s | всего: %.2fs", ", ".join(f"{p}: {d:.2f}s" for p, d in spans), time.perf_counter() - t0)
     
-    def end(self, phase: str):
-        if self.enabled and f"{phase}_start" in self.timings:
-            duration = time.perf_counter() - self.timings[f"{phase}_start"]
-            print(f"[PERF] {phase}: {duration:.2f}s")
-            return duration
+    def timed(self, phase: str):
+        """Декоратор узла графа. При выключенном мониторинге возвращает функцию без обертки"""
+        def decorator(fn):
+            if not self.enabled:
+                return fn
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with self.span(phase):
+                    return await fn(*args, **kwargs)
+            return wrapper
+        return decorator
     
     def log_stat(self, stat_name: str):
         if stat_name in self.stats:
@@ -53,16 +114,16 @@ class PerformanceMonitor:
 
 perf = PerformanceMonitor()
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class AudioMsg:
-    raw: bytes
+    raw: bytes  # bytes или bytearray (входящий буфер передается без копирования)
     sr: int = 16000
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class TextMsg:
     text: str
 
-@dataclass
+@dataclass(slots=True)
 class AgentState:
     audio: Optional[AudioMsg] = None
     text: Optional[TextMsg] = None
@@ -71,6 +132,12 @@ class AgentState:
     # Новые поля для отслеживания
     parse_method: Optional[str] = None  # direct, llm_assisted, llm_only
     confidence: Optional[float] = None
+    # Ключ кэша ответов: tts_node сохраняет под ним озвученный ответ LLM
+    response_key: Optional[str] = None
+    # Поток аудио к клиенту: если задан, ответ LLM отправляется по предложениям по мере синтеза
+    audio_sink: Optional["AudioStream"] = None
+    # text уже готовый ответ (например, сообщение об ошибке STT): парсинг и LLM пропускаются
+    is_reply: bool = False
 
 # WebSocket настройки
 STT_WS_HOST = os.getenv("STT_WS_HOST", "localhost") 
@@ -78,14 +145,71 @@ STT_WS_PORT = int(os.getenv("STT_WS_PORT", 8778))
 TTS_WS_HOST = os.getenv("TTS_WS_HOST", "localhost")
 TTS_WS_PORT = int(os.getenv("TTS_WS_PORT", 8777))
 
-processing_lock = asyncio.Lock()
+# Протокол потокового ответа: клиент объявляет поддержку сообщением STREAM_AUDIO,
+# после чего ответ может прийти как BEGIN, несколько WAV по предложениям, END
+AUDIO_STREAM_HELLO = "STREAM_AUDIO"
+AUDIO_STREAM_BEGIN = "AUDIO_STREAM_BEGIN"
+AUDIO_STREAM_END = "AUDIO_STREAM_END"
+
+class AudioStream:
+    """Отправляет клиенту WAV-фрагменты ответа, как только они синтезированы"""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.started = False
+
+    async def send(self, wav: bytes):
+        if not self.started:
+            self.started = True
+            await self.ws.send(AUDIO_STREAM_BEGIN)
+        await self.ws.send(wav)
+
+    async def end(self):
+        if self.started:
+            await self.ws.send(AUDIO_STREAM_END)
+
+# Пул воркеров вместо глобальной блокировки: пока один запрос ждет LLM, другой может идти через STT/TTS
+N_WORKERS = int(os.getenv("WORKERS", "2"))
+work_queue = asyncio.Queue(maxsize=int(os.getenv("WORK_QUEUE_SIZE", str(N_WORKERS))))
+# Сколько запросов к LLM пускать одновременно. Облачные API и Ollama с OLLAMA_NUM_PARALLEL > 1
+# сами объединяют параллельные запросы в батч; Ollama по умолчанию обрабатывает их по одному
+_llm_parallel = N_WORKERS if LLM_PROVIDER != "local" else int(os.getenv("OLLAMA_NUM_PARALLEL", "1"))
+llm_semaphore = asyncio.Semaphore(int(os.getenv("LLM_CONCURRENCY", str(_llm_parallel))))
+# Время последнего запроса пользователя к LLM (time.monotonic): пока модель в работе, heartbeat не нужен
+llm_last_used = float("-inf")
+
+@asynccontextmanager
+async def llm_slot():
+    """Место в llm_semaphore для запроса пользователя"""
+    global llm_last_used
+    async with llm_semaphore:
+        try:
+            yield
+        finally:
+            llm_last_used = time.monotonic()
+
+# Простой системный промпт для разговора. Строка не меняется между запросами,
+# поэтому провайдер может переиспользовать кэш префикса
+SYSTEM_PROMPT = """Ты дружелюбный голосовой помощник. 
+Отвечай кратко и естественно на русском языке.
+Если не понимаешь команду, честно скажи об этом и предложи помощь."""
 
 # Кэш для LLM
 llm_manager = LLMManager()
-llm_cache = {}
+# LRU: частые запросы продвигаются при попадании и не вытесняются раньше редких.
+# Ответы - короткие строки, поэтому размер можно держать большим
+llm_cache = LRUCache(maxsize=int(os.getenv("LLM_CACHE_SIZE", "256")))
 
-def get_cache_key(prompt: str, system_prompt: str) -> str:
-    return hashlib.md5(f"{system_prompt}|{prompt}".encode()).hexdigest()
+@functools.lru_cache(maxsize=8)
+def _system_prompt_digest(system_prompt: str) -> bytes:
+    # Системных промптов всего два (ответ и парсер): хэшируем каждый один раз
+    return hashlib.blake2b(system_prompt.encode(), digest_size=16).digest()
+
+def get_cache_key(prompt: str, system_prompt: str) -> bytes:
+    # Ключ словаря, наружу не выводится: сырые байты без hex
+    h = hashlib.blake2b(_system_prompt_digest(system_prompt), digest_size=16)
+    h.update(prompt.encode())
+    return h.digest()
 
 def get_cached_response(prompt: str, system_prompt: str) -> Optional[str]:
     cache_key = get_cache_key(prompt, system_prompt)
@@ -94,108 +218,395 @@ def get_cached_response(prompt: str, system_prompt: str) -> Optional[str]:
 def cache_response(prompt: str, system_prompt: str, response: str):
     cache_key = get_cache_key(prompt, system_prompt)
     llm_cache[cache_key] = response
-    if len(llm_cache) > 50:  # Уменьшили размер кэша для экономии памяти
-        oldest_key = next(iter(llm_cache))
-        del llm_cache[oldest_key]
 
-# STT и TTS клиенты (без изменений)
+# Кэш готовых ответов (текст + аудио) для повторяющихся фраз: попадание пропускает и LLM, и TTS.
+# Кэшируются только ответы LLM - результаты инструментов (время, погода) меняются.
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "64"))  # WAV по сотне КБ, держим немного
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+def response_cache_key(text: str) -> str:
+    return text.strip().lower()
+
+# Семантический кэш ловит перефразированные повторы, которые не совпали с точным ключом.
+# Выключен по умолчанию: модель эмбеддингов тянет torch и занимает память
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "false").lower() == "true"
+semantic_cache = None
+if SEMANTIC_CACHE:
+    from semantic_cache import SemanticCache
+    semantic_cache = SemanticCache(
+        os.getenv("SEMANTIC_CACHE_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"),
+        threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")),
+        maxsize=int(os.getenv("SEMANTIC_CACHE_SIZE", "100")),
+        ttl=RESPONSE_CACHE_TTL,  # устаревает вместе с точным кэшем ответов
+    )
+
+async def lookup_llm_cache(prompt: str, system_prompt: str, semantic: bool = True) -> Optional[str]:
+    """Точное совпадение по ключу BLAKE2b, затем поиск по смыслу среди ответов на тот же системный промпт"""
+    cached = get_cached_response(prompt, system_prompt)
+    if cached is None and semantic and semantic_cache:
+        cached = await semantic_cache.lookup(response_cache_key(prompt), namespace=system_prompt)
+    return cached
+
+async def store_llm_cache(prompt: str, system_prompt: str, response: str, semantic: bool = True):
+    cache_response(prompt, system_prompt, response)
+    if semantic and semantic_cache:
+        await semantic_cache.add(response_cache_key(prompt), response, namespace=system_prompt)
+
+class PersistentWS:
+    """Долгоживущее WebSocket соединение к STT/TTS сервису с переподключением при ошибке"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.ws = None
+        self.lock = asyncio.Lock()
+
+    async def _connect(self):
+        # compression=None: аудио не сжимается deflate, а zlib тратит CPU и память на каждый кадр.
+        # ping_timeout с запасом: сервер Vosk не отвечает на ping, пока декодирует длинную фразу
+        self.ws = await websockets.connect(self.url, max_size=8*2**20, ping_interval=30, ping_timeout=60,
+                                           compression=None)
+        return self.ws
+
+    async def get(self):
+        """Возвращает открытое соединение, переподключаясь, если оно уже закрыто. Вызывать под self.lock"""
+        ws = self.ws
+        if ws is None or ws.close_code is not None:
+            ws = await self._connect()
+        return ws
+
+    async def ensure(self):
+        """Заранее открывает соединение, чтобы запрос не ждал рукопожатия. Ошибки не фатальны"""
+        try:
+            async with self.lock:
+                await self.get()
+        except Exception as e:
+            log.debug("Не удалось открыть %s заранее: %s", self.url, e)
+
+    async def request(self, payload):
+        """Отправляет запрос и ждет один ответ. Соединение переиспользуется между вызовами."""
+        async with self.lock:
+            ws = self.ws
+            try:
+                if ws is None or ws.close_code is not None:
+                    # Закрытие уже замечено: не тратим попытку отправки на мертвое соединение
+                    ws = await self.get()
+                    await ws.send(payload)
+                    return await ws.recv()
+                try:
+                    await ws.send(payload)
+                    return await ws.recv()
+                except websockets.exceptions.ConnectionClosed:
+                    # Сервер закрыл простаивающее соединение - переподключаемся один раз
+                    ws = await self._connect()
+                    await ws.send(payload)
+                    return await ws.recv()
+            except BaseException:
+                # Обмен прерван ошибкой или отменой задачи: ответ мог остаться в сокете
+                # и достаться следующему запросу, поэтому соединение не переиспользуем
+                self.discard()
+                raise
+
+    def discard(self):
+        """Сразу забывает соединение, закрывая его в фоне: можно вызывать из отмененной задачи"""
+        ws, self.ws = self.ws, None
+        if ws is not None:
+            task = asyncio.create_task(_close_quietly(ws))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+
+    async def close(self):
+        ws, self.ws = self.ws, None
+        if ws is not None:
+            await _close_quietly(ws)
+
+async def _close_quietly(ws):
+    try:
+        await ws.close()
+    except Exception:
+        pass
+
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+background_tasks = set()
+
+class WSPool:
+    """Пул долгоживущих соединений к сервису: параллельные запросы не ждут друг друга"""
+
+    def __init__(self, url: str, size: int):
+        self.url = url
+        # LIFO: запрос берет соединение, которое вернули или прогрели последним, оно заведомо живое
+        self.idle = asyncio.LifoQueue()
+        for _ in range(max(1, size)):
+            self.idle.put_nowait(PersistentWS(url))
+
+    async def request(self, payload):
+        conn = await self.idle.get()
+        try:
+            return await conn.request(payload)
+        except BaseException:
+            # Прерванный обмен: в пул соединение возвращается только сброшенным
+            conn.discard()
+            raise
+        finally:
+            self.idle.put_nowait(conn)
+
+    async def warmup(self):
+        """Открывает все соединения пула сразу, чтобы первые параллельные запросы не ждали рукопожатия"""
+        conns = [self.idle.get_nowait() for _ in range(self.idle.qsize())]
+        try:
+            await asyncio.gather(*(conn.ensure() for conn in conns))
+        finally:
+            for conn in conns:
+                self.idle.put_nowait(conn)
+
+    async def ensure(self):
+        """Открывает заранее свободное соединение; занятые и так подключены"""
+        if self.idle.empty():
+            return
+        conn = self.idle.get_nowait()
+        try:
+            await conn.ensure()
+        finally:
+            self.idle.put_nowait(conn)
+
+# Серверы STT/TTS обрабатывают запросы одного соединения по очереди,
+# поэтому параллельные воркеры и предложения потокового TTS идут по разным соединениям
+stt_ws = WSPool(f"ws://{STT_WS_HOST}:{STT_WS_PORT}", int(os.getenv("STT_POOL_SIZE", str(N_WORKERS))))
+tts_ws = WSPool(f"ws://{TTS_WS_HOST}:{TTS_WS_PORT}", int(os.getenv("TTS_POOL_SIZE", "2")))
+
+# STT и TTS клиенты
 async def stt_vosk(audio: AudioMsg) -> str:
-    print(f"[LOG] [STT] Отправка аудио ({len(audio.raw)} байт)")
+    log.debug("[STT] Отправка аудио (%d байт)", len(audio.raw))
     try:
-        async with websockets.connect(f"ws://{STT_WS_HOST}:{STT_WS_PORT}", max_size=8*2**20) as ws:
-            await ws.send(audio.raw)
-            resp = await ws.recv()
-            if isinstance(resp, str) and not resp.startswith("ERROR"):
-                return resp
+        resp = await stt_ws.request(audio.raw)
+        if not isinstance(resp, str) or resp.startswith("ERROR"):
             raise RuntimeError(f"STT error: {resp}")
+        resp = resp.strip()
+        # Сервер может вернуть сырой результат Vosk {"text": "..."}: разбираем здесь,
+        # дальше по конвейеру идет только чистый текст
+        if resp[:1] == "{":
+            return orjson.loads(resp).get("text", "").strip()
+        return resp
     except Exception as e:
-        print(f"[ERROR] STT error: {e}")
+        log.error("STT error: %s", e)
         raise
 
+_THINK_BLOCK = re.compile(r'<think>.*?</think>', re.DOTALL | re.IGNORECASE)
+_THINK_OPEN = re.compile(r'<think>', re.IGNORECASE)
+_THINK_CLOSE = re.compile(r'</think>', re.IGNORECASE)
+
 def extract_tts_text(text: str) -> str:
     if not isinstance(text, str):
         text = str(text)
+    # Модели часто начинают ответ с перевода строки: JSON узнаем по первому непробельному символу
+    text = text.strip()
+    first = text[:1]
+    # Обычный текст без тегов и JSON - основной случай, регулярки и парсер не нужны
+    if '<' not in text and first not in ('[', '{'):
+        return text
     # Удаляем все блоки <think>...</think> и берем только то, что после последнего </think>
-    think_pattern = re.compile(r'<think>.*?</think>', re.DOTALL | re.IGNORECASE)
-    if re.search(think_pattern, text):
-        # Берем только текст после последнего </think>
-        parts = re.split(r'</think>', text, flags=re.IGNORECASE)
-        if len(parts) > 1:
-            return parts[-1].strip()
-        else:
-            # Если почему-то нет закрывающего тега, просто удаляем <think>...</think>
-            return re.sub(think_pattern, '', text).strip()
+    if '<' in text:
+        # Модели пишут теги строчными: поиск подстроки за один проход, без регулярного выражения
+        end = text.rfind('</think>')
+        if end != -1 and text.find('<think>', 0, end) != -1:
+            return text[end + len('</think>'):].strip()
+        if _THINK_BLOCK.search(text):  # теги в другом регистре
+            return _THINK_CLOSE.split(text)[-1].strip()
     # Старое поведение для json-ответов
-    if text.startswith('[') or text.startswith('{'):
+    if first in ('[', '{'):
         try:
-            data = json.loads(text)
-            if isinstance(data, list):
-                return " ".join(item.get('text', str(item)) for item in data if isinstance(item, dict) and item.get('type') != 'tool_use')
-            elif isinstance(data, dict):
-                return data.get('text', data.get('content', str(data)))
-        except:
-            pass
-    return text.strip()
+            data = orjson.loads(text)
+        except orjson.JSONDecodeError:
+            return text
+        t = type(data)
+        if t is list:
+            out = []
+            for item in data:
+                if type(item) is dict and item.get('type') != 'tool_use':
+                    out.append(str(item.get('text', item)))  # text может оказаться не строкой
+            return " ".join(out)
+        elif t is dict:
+            return data.get('text', data.get('content', str(data)))
+    return text
 
-async def tts_client(text: str) -> bytes:
+async def tts_client(text: str, conn=None) -> bytes:
+    """Синтез через пул tts_ws или через отдельное соединение conn"""
     text = extract_tts_text(text)
-    print(f"[LOG] [TTS] Синтез: {text[:100]}...")
+    log.debug("[TTS] Синтез: %.100s...", text)
     try:
-        async with websockets.connect(f"ws://{TTS_WS_HOST}:{TTS_WS_PORT}", max_size=8*2**20) as ws:
-            await ws.send(text)
-            resp = await ws.recv()
-            if isinstance(resp, bytes):
-                return resp
-            raise RuntimeError(f"TTS error: {resp}")
+        resp = await (conn or tts_ws).request(text)
+        if isinstance(resp, bytes):
+            return resp
+        raise RuntimeError(f"TTS error: {resp}")
     except Exception as e:
-        print(f"[ERROR] TTS error: {e}")
+        log.error("TTS error: %s", e)
         raise
 
+_SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+
+class SentenceSplitter:
+    """Накапливает токены LLM и отдает законченные предложения для TTS (блоки <think> пропускаются)"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.in_think = False
+
+    def feed(self, token: str) -> List[str]:
+        self.buffer += token
+        return self._drain(final=False)
+
+    def flush(self) -> List[str]:
+        return self._drain(final=True)
+
+    def _drain(self, final: bool) -> List[str]:
+        sentences = []
+        while True:
+            if self.in_think:
+                close = _THINK_CLOSE.search(self.buffer) if '<' in self.buffer else None
+                if not close:
+                    # Рассуждение не озвучивается: храним только хвост, где может начинаться </think>,
+                    # чтобы не сканировать заново весь растущий блок на каждом токене
+                    self.buffer = "" if final else self.buffer[-(len('</think>') - 1):]
+                    return sentences
+                self.buffer = self.buffer[close.end():]
+                self.in_think = False
+            
+            open_ = _THINK_OPEN.search(self.buffer) if '<' in self.buffer else None
+            text = self.buffer[:open_.start()] if open_ else self.buffer
+            parts = _SENTENCE_END.split(text)
+            if open_:
+                # Текст до <think> уже закончен
+                sentences.extend(p.strip() for p in parts if p.strip())
+                self.buffer = self.buffer[open_.end():]
+                self.in_think = True
+                continue
+            
+            if final:
+                sentences.extend(p.strip() for p in parts if p.strip())
+                self.buffer = ""
+            else:
+                sentences.extend(p.strip() for p in parts[:-1] if p.strip())
+                self.buffer = parts[-1]
+            return sentences
+
+def concat_wav(chunks: List[bytes]) -> bytes:
+    """Склеивает WAV-фрагменты с одинаковыми параметрами в один WAV"""
+    out = io.BytesIO()
+    with wave.open(out, "wb") as dst:
+        for i, chunk in enumerate(chunks):
+            with wave.open(io.BytesIO(chunk), "rb") as src:
+                if i == 0:
+                    dst.setparams(src.getparams())
+                dst.writeframes(src.readframes(src.getnframes()))
+    return out.getvalue()
+
+async def _send_in_order(queue: asyncio.Queue, sink: AudioStream):
+    """Отправляет синтезированные предложения клиенту строго по порядку"""
+    while (task := await queue.get()) is not None:
+        try:
+            wav = await task
+        except Exception as e:
+            log.error("TTS предложения не удался: %s", e)
+            continue
+        await sink.send(wav)
+
+async def stream_llm_to_tts(txt: str, system_prompt: str, sink: Optional[AudioStream] = None):
+    """
+    Генерирует ответ LLM потоково и запускает TTS для каждого готового предложения,
+    не дожидаясь конца генерации. Если задан sink, каждое предложение сразу уходит клиенту.
+    Возвращает (текст ответа, AudioMsg или None).
+    """
+    splitter = SentenceSplitter()
+    parts = []
+    tts_tasks = []
+    send_queue = asyncio.Queue() if sink else None
+    sender = asyncio.create_task(_send_in_order(send_queue, sink)) if sink else None
+    
+    def start_tts(sentence: str):
+        task = asyncio.create_task(tts_client(sentence))
+        tts_tasks.append(task)
+        if send_queue:
+            send_queue.put_nowait(task)
+    
+    try:
+        async with llm_slot():
+            async for token in llm_manager.stream_response(txt, system_prompt):
+                parts.append(token)
+                for sentence in splitter.feed(token):
+                    start_tts(sentence)
+        for sentence in splitter.flush():
+            start_tts(sentence)
+        
+        content = "".join(parts)
+        if sender:
+            send_queue.put_nowait(None)
+            try:
+                await sender
+            except Exception as e:
+                # Клиент ушел: это не ошибка LLM, ответ все равно возвращается и кэшируется
+                log.warning("Не удалось отправить ответ клиенту: %s", e)
+        if not tts_tasks:
+            return content, None
+        
+        wavs = await asyncio.gather(*tts_tasks, return_exceptions=True)
+        if any(isinstance(w, BaseException) for w in wavs):
+            # Если хотя бы одно предложение не синтезировалось, tts_node озвучит ответ целиком
+            return content, None
+        try:
+            return content, AudioMsg(concat_wav(wavs), sr=48000)
+        except Exception as e:
+            log.error("Не удалось склеить аудио: %s", e)
+            return content, None
+    finally:
+        # При ошибке LLM или отмене запроса не оставляем висящих задач синтеза и отправки
+        tasks = tts_tasks + [sender] if sender else tts_tasks
+        for task in tasks:
+            task.cancel()
+        # Забираем результаты, чтобы исключения задач не терялись
+        await asyncio.gather(*tasks, return_exceptions=True)
+
 # Гибридная функция для LLM-помощи в парсинге
 async def llm_assisted_parse(text: str) -> Optional[List[ToolCall]]:
     """Использует LLM для помощи в парсинге неоднозначных команд"""
     system_prompt = tool_parser.get_simple_system_prompt()
     
     # Проверяем кэш
-    cached = get_cached_response(text, system_prompt)
+    cached = await lookup_llm_cache(text, system_prompt)
     if cached:
         return _parse_llm_response(cached, text)
     
     try:
-        print(f"[DEBUG] LLM-помощь для парсинга: '{text}'")
+        log.debug("LLM-помощь для парсинга: '%s'", text)
         perf.log_stat("llm_calls")
         
-        result = await llm_manager.llm.ainvoke([
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": text}
-        ])
+        async with llm_slot():
+            result = await llm_manager.llm.ainvoke(llm_manager.build_messages(text, system_prompt))
         
-        content = result.content if hasattr(result, 'content') else str(result)
+        content = result.content  # чат-модели всегда возвращают AIMessage
         content = content.strip().upper()
         
-        print(f"[DEBUG] LLM ответ: {content}")
-        cache_response(text, system_prompt, content)
+        log.debug("LLM ответ: %s", content)
+        await store_llm_cache(text, system_prompt, content)
         
         return _parse_llm_response(content, text)
         
     except Exception as e:
-        print(f"[ERROR] LLM-помощь failed: {e}")
+        log.error("LLM-помощь failed: %s", e)
         return None
 
+# Ответ LLM-помощника -> имя инструмента
+LLM_TOOL_NAMES = {
+    "ВРЕМЯ": "get_time",
+    "ПОГОДА": "get_weather", 
+    "ТАЙМЕР": "set_timer",
+    "НАПОМИНАНИЕ": "set_notification",
+    "ЗВОНОК": "call_contact"
+}
+
 def _parse_llm_response(llm_response: str, original_text: str) -> Optional[List[ToolCall]]:
     """Парсит ответ LLM и создает ToolCall"""
-    llm_response = llm_response.strip().upper()
-    
-    tool_mapping = {
-        "ВРЕМЯ": "get_time",
-        "ПОГОДА": "get_weather", 
-        "ТАЙМЕР": "set_timer",
-        "НАПОМИНАНИЕ": "set_notification",
-        "ЗВОНОК": "call_contact"
-    }
-    
-    if llm_response in tool_mapping:
-        tool_name = tool_mapping[llm_response]
+    tool_name = LLM_TOOL_NAMES.get(llm_response.strip().upper())
+    if tool_name:
         args = tool_parser._extract_args(tool_name, original_text)
         return [ToolCall(name=tool_name, args=args, confidence=0.7)]
     
@@ -203,62 +614,167 @@ def _parse_llm_response(llm_response: str, original_text: str) -> Optional[List[
 
 # Предзагрузка моделей
 async def preload_models():
-    print("[INFO] Предзагрузка моделей...")
+    log.info("Предзагрузка моделей...")
+    await asyncio.gather(stt_ws.warmup(), tts_ws.warmup())
     
     try:
         test_audio = AudioMsg(b'\x00' * 1600, sr=16000)
         await stt_vosk(test_audio)
-        print("[INFO] STT готов")
+        log.info("STT готов")
     except:
-        print("[WARNING] STT недоступен")
+        log.warning("STT недоступен")
     
     try:
         await tts_client("Тест")
-        print("[INFO] TTS готов")
+        log.info("TTS готов")
     except:
-        print("[WARNING] TTS недоступен")
+        log.warning("TTS недоступен")
     
-    print("[INFO] Предзагрузка завершена")
+    global semantic_cache
+    if semantic_cache:
+        try:
+            await asyncio.to_thread(semantic_cache.load)
+            log.info("Семантический кэш готов")
+        except Exception as e:
+            log.warning("Семантический кэш отключен: %s", e)
+            semantic_cache = None
+    
+    log.info("Предзагрузка завершена")
+
+# Ответы инструментов - короткий набор шаблонов из mqtt_tools: их озвучка собирается
+# из фрагментов, синтезированных заранее, и не ждет Piper
+TTS_FRAGMENTS = os.getenv("TTS_FRAGMENTS", "true").lower() == "true"
+TOOL_PHRASES = (
+    "Таймер установлен",
+    "Не удалось установить таймер",
+    "Не удалось получить информацию о погоде",
+    "Информация о погоде недоступна без MQTT подключения",
+    "Команда не найдена",
+    "Команда выполнена",
+)
+# Служебные ответы агента тоже постоянны: озвучиваются из кэша фрагментов
+STT_ERROR_REPLY = "Ошибка распознавания речи"
+LLM_ERROR_REPLY = "Извините, произошла ошибка."
+SERVICE_PHRASES = (STT_ERROR_REPLY, LLM_ERROR_REPLY)
+# (шаблон, части фразы): строки - постоянные фрагменты, числа - номера групп шаблона
+TOOL_TEMPLATES = (
+    (re.compile(r"Текущее время (\d+) часов, (\d+) минут"), ("Текущее время", 1, "часов,", 2, "минут")),
+)
+tts_fragment_cache: Dict[str, bytes] = {}
+# Предсинтез идет через свое соединение и не занимает пул tts_ws, которым пользуются живые ответы
+tts_prewarm_ws = PersistentWS(tts_ws.url)
+# Числа шаблонов (0-59) синтезируются по первому промаху, а не все при старте
+tts_fragment_pending = set()
+
+async def prewarm_tts_fragments():
+    """Синтезирует постоянные фразы и постоянные части шаблонов ответов инструментов"""
+    stems = [p for _, parts in TOOL_TEMPLATES for p in parts if isinstance(p, str)]
+    for text in (*TOOL_PHRASES, *SERVICE_PHRASES, *stems):
+        try:
+            tts_fragment_cache[text] = await tts_client(text, tts_prewarm_ws)
+        except Exception as e:
+            log.warning("Предсинтез фрагментов TTS прерван: %s", e)
+            return
+    log.info("Предсинтезировано фрагментов TTS: %d", len(tts_fragment_cache))
+
+async def _synthesize_fragments(pieces: List[str]):
+    try:
+        for text in pieces:
+            tts_fragment_cache[text] = await tts_client(text, tts_prewarm_ws)
+    except Exception as e:
+        log.warning("Фрагменты TTS не синтезированы: %s", e)
+    finally:
+        tts_fragment_pending.difference_update(pieces)
+
+def _schedule_fragments(pieces: List[str]):
+    """Досинтезирует недостающие фрагменты в фоне: следующий такой ответ соберется из кэша"""
+    missing = [p for p in dict.fromkeys(pieces) if p not in tts_fragment_cache and p not in tts_fragment_pending]
+    if missing:
+        tts_fragment_pending.update(missing)
+        task = asyncio.create_task(_synthesize_fragments(missing))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+def fragment_tts(text: str) -> Optional[bytes]:
+    """Собирает WAV ответа инструмента из готовых фрагментов; None, если чего-то не хватает"""
+    wav = tts_fragment_cache.get(text)
+    if wav is not None:
+        return wav
+    for pattern, parts in TOOL_TEMPLATES:
+        m = pattern.fullmatch(text)
+        if m:
+            pieces = [p if isinstance(p, str) else m.group(p) for p in parts]
+            if all(p in tts_fragment_cache for p in pieces):
+                return concat_wav([tts_fragment_cache[p] for p in pieces])
+            _schedule_fragments(pieces)
+    return None
+
+# Прогрев LLM: только для локальной модели, облачные вызовы платные
+LLM_WARMUP = os.getenv("LLM_WARMUP", "true").lower() == "true" and llm_manager.provider == "local"
+# Ollama хранит KV-кэш последнего промпта; периодический запрос держит в нем системный промпт разговора
+LLM_HEARTBEAT_INTERVAL = int(os.getenv("LLM_HEARTBEAT_INTERVAL", "240"))
+# Для прогрева нужен только prefill: один токен вместо полного ответа
+warmup_model = llm_manager.llm.model_copy(update={"num_predict": 1}) if LLM_WARMUP else None
+
+async def warmup_llm():
+    """Прогоняет системный промпт через LLM, чтобы первый запрос пользователя не платил за prefill"""
+    async with llm_semaphore:
+        await warmup_model.ainvoke(llm_manager.build_messages("Готов?", SYSTEM_PROMPT))
+
+async def llm_warmup_loop():
+    """Фоновый прогрев LLM при старте и затем раз в LLM_HEARTBEAT_INTERVAL секунд простоя"""
+    while True:
+        # Занятую модель не трогаем: запрос пользователя не должен ждать прогрев
+        idle = time.monotonic() - llm_last_used >= LLM_HEARTBEAT_INTERVAL
+        if idle and not llm_semaphore.locked():
+            try:
+                await warmup_llm()
+                log.info("LLM прогрет")
+            except Exception as e:
+                log.warning("Не удалось прогреть LLM: %s", e)
+        if LLM_HEARTBEAT_INTERVAL <= 0:
+            return
+        await asyncio.sleep(LLM_HEARTBEAT_INTERVAL)
 
 # Узлы обработки
+@perf.timed("stt")
 async def stt_node(state: AgentState) -> AgentState:
-    perf.start("stt")
     if state.audio:
         try:
             recognized_text = await stt_vosk(state.audio)
             if recognized_text and recognized_text.strip() != "Не удалось распознать речь":
                 state.text = TextMsg(recognized_text)
-                print(f"[INFO] Распознан текст: {recognized_text}")
+                log.info("Распознан текст: %s", recognized_text)
             else:
                 state.text = None
         except Exception as e:
-            print(f"[ERROR] STT error: {e}")
-            state.text = TextMsg("Ошибка распознавания речи")
-    perf.end("stt")
+            log.error("STT error: %s", e)
+            state.text = TextMsg(STT_ERROR_REPLY)
+            state.is_reply = True
+        # Входное аудио больше не нужно, дальше state.audio хранит ответ
+        state.audio = None
     return state
 
+@perf.timed("parsing")
 async def intelligent_parsing_node(state: AgentState) -> AgentState:
     """Умный узел парсинга с гибридным подходом"""
-    perf.start("parsing")
     perf.log_stat("total_requests")
     
-    if not state.text:
-        perf.end("parsing")
+    if not state.text or state.is_reply:
         return state
     
     txt = state.text.text
-    print(f"[DEBUG] Интеллектуальный парсинг: '{txt}'")
+    log.debug("Интеллектуальный парсинг: '%s'", txt)
     
     # 1. Пробуем прямой парсинг
     direct_result = tool_parser.parse_text_for_tools(txt, use_llm_fallback=False)
     
     if direct_result and direct_result[0].confidence >= CONFIDENCE_THRESHOLD:
-        print(f"[DEBUG] Прямой парсинг успешен: {direct_result[0].name} (conf: {direct_result[0].confidence:.2f})")
-        state.tool_calls = [_convert_to_tool_call_dict(tc) for tc in direct_result]
+        log.debug("Прямой парсинг успешен: %s (conf: %.2f)", direct_result[0].name, direct_result[0].confidence)
+        state.tool_calls = _convert_to_tool_call_dicts(direct_result)
         state.parse_method = "direct"
         state.confidence = direct_result[0].confidence
         perf.log_stat("direct_parse")
-        perf.end("parsing")
         return state
     
     # 2. Если прямой парсинг неуспешен и разрешен LLM fallback
@@ -266,11 +782,10 @@ async def intelligent_parsing_node(state: AgentState) -> AgentState:
         llm_result = await llm_assisted_parse(txt)
         
         if llm_result and llm_result[0].confidence >= CONFIDENCE_THRESHOLD:
-            print(f"[DEBUG] LLM-помощь успешна: {llm_result[0].name} (conf: {llm_result[0].confidence:.2f})")
-            state.tool_calls = [_convert_to_tool_call_dict(tc) for tc in llm_result]
+            log.debug("LLM-помощь успешна: %s (conf: %.2f)", llm_result[0].name, llm_result[0].confidence)
+            state.tool_calls = _convert_to_tool_call_dicts(llm_result)
             state.parse_method = "llm_assisted"
             state.confidence = llm_result[0].confidence
-            perf.end("parsing")
             return state
     
     # 3. Если ничего не сработало, используем обычный LLM для генерации ответа
@@ -278,134 +793,172 @@ async def intelligent_parsing_node(state: AgentState) -> AgentState:
         state.parse_method = "llm_only"
         # Переходим к обычной генерации LLM
     
-    perf.end("parsing")
     return state
 
-def _convert_to_tool_call_dict(tc: ToolCall) -> Dict[str, Any]:
+def _convert_to_tool_call_dicts(tool_calls: List[ToolCall]) -> List[Dict[str, Any]]:
     """Конвертирует ToolCall в формат для tools_node"""
-    return {
-        "name": tc.name,
-        "args": tc.args,
-        "id": f"tool_{tc.name}_{int(time.time())}"
-    }
+    # Одна отметка времени на пакет; индекс различает одноименные вызовы, иначе их результаты затирают друг друга
+    ts = time.time_ns()
+    return [
+        {
+            "name": tc.name,
+            "args": tc.args,
+            "id": f"tool_{tc.name}_{ts}_{i}"
+        }
+        for i, tc in enumerate(tool_calls)
+    ]
 
+@perf.timed("llm")
 async def llm_node(state: AgentState) -> AgentState:
     """Упрощенный LLM узел для случаев когда парсинг не сработал"""
-    perf.start("llm")
     
     if not state.text:  # Убираем проверку на tool_calls
-        perf.end("llm")
         return state
     
     txt = state.text.text
+    system_prompt = SYSTEM_PROMPT
     
-    # Простой системный промпт для разговора
-    system_prompt = """Ты дружелюбный голосовой помощник. 
-Отвечай кратко и естественно на русском языке.
-Если не понимаешь команду, честно скажи об этом и предложи помощь."""
+    # Готовый озвученный ответ на ту же фразу
+    response_key = response_cache_key(txt)
+    hit = response_cache.get(response_key)
+    if hit:
+        state.text, state.audio = hit
+        log.debug("Ответ из кэша для: '%s'", txt)
+        return state
+    if semantic_cache:
+        hit = await semantic_cache.lookup(response_key)
+        if hit:
+            state.text, state.audio = hit
+            return state
+    state.response_key = response_key
     
-    # Проверяем кэш
-    cached = get_cached_response(txt, system_prompt)
+    # Проверяем кэш. Семантически фраза ответа хранится одной записью (текст + аудио) из tts_node
+    cached = await lookup_llm_cache(txt, system_prompt, semantic=False)
     if cached:
         state.text = TextMsg(cached)
-        perf.end("llm")
         return state
     
     try:
-        print(f"[DEBUG] LLM генерация ответа для: '{txt}'")
+        log.debug("LLM генерация ответа для: '%s'", txt)
         perf.log_stat("llm_calls")
         
-        result = await llm_manager.llm.ainvoke([
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": txt}
-        ])
+        if STREAM_TTS:
+            content, audio = await stream_llm_to_tts(txt, system_prompt, state.audio_sink)
+            if audio:
+                state.audio = audio
+        else:
+            async with llm_slot():
+                result = await llm_manager.llm.ainvoke(llm_manager.build_messages(txt, system_prompt))
+            content = result.content  # чат-модели всегда возвращают AIMessage
         
-        content = result.content if hasattr(result, 'content') else str(result)
-        cache_response(txt, system_prompt, content)
+        await store_llm_cache(txt, system_prompt, content, semantic=False)
         state.text = TextMsg(content)
         
     except Exception as e:
-        print(f"[ERROR] LLM error: {e}")
-        state.text = TextMsg("Извините, произошла ошибка.")
+        log.error("LLM error: %s", e)
+        state.text = TextMsg(LLM_ERROR_REPLY)
+        state.response_key = None
     
-    perf.end("llm")
     return state
 
+# Отдельный пул для инструментов: их ожидание MQTT не занимает потоки default executor,
+# которыми пользуются asyncio.to_thread и websockets
+tool_pool = ThreadPoolExecutor(max_workers=int(os.getenv("TOOL_WORKERS", "4")), thread_name_prefix="tool")
+
 # Остальные узлы (без изменений)
+@perf.timed("tools")
 async def tools_node(state: AgentState) -> AgentState:
     if not state.tool_calls:
         return state
     
-    perf.start("tools")
     perf.log_stat("tool_calls")
-    print(f"[LOG] [TOOLS] Выполнение {len(state.tool_calls)} инструментов")
+    log.debug("[TOOLS] Выполнение %d инструментов", len(state.tool_calls))
+    loop = asyncio.get_running_loop()
     
-    async def execute_tool_async(tool_call):
-        if isinstance(tool_call, dict):
-            tool_name = tool_call.get("name")
-            tool_args = tool_call.get("args", {})
-            tool_id = tool_call.get("id", f"tool_{tool_name}_{int(time.time())}")
-        else:
-            tool_name = getattr(tool_call, "name", None)
-            tool_args = getattr(tool_call, "args", {})
-            tool_id = getattr(tool_call, "id", f"tool_{tool_name}_{int(time.time())}")
+    async def execute_tool_async(tool_call: Dict[str, Any]):
+        # Вызовы всегда собирает _convert_to_tool_call_dicts: name, args, id
+        tool_name = tool_call["name"]
+        tool_args = tool_call["args"]
+        tool_id = tool_call["id"]
         
         if not tool_name:
-            print(f"[ERROR] Не найдено имя инструмента в: {tool_call}")
+            log.error("Не найдено имя инструмента в: %s", tool_call)
             return None
         
-        print(f"[DEBUG] Выполняю инструмент: {tool_name} с аргументами: {tool_args}")
+        log.debug("Выполняю инструмент: %s с аргументами: %s", tool_name, tool_args)
         
         try:
             if isinstance(tool_args, str):
-                tool_args = json.loads(tool_args)
+                tool_args = orjson.loads(tool_args)
         except:
             tool_args = {}
         
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, execute_tool, tool_name, tool_args)
-        print(f"[DEBUG] Результат инструмента {tool_name}: {result}")
+        # execute_tool синхронный и ждет MQTT: в потоке он не блокирует остальные вызовы
+        result = await loop.run_in_executor(tool_pool, execute_tool, tool_name, tool_args)
+        log.debug("Результат инструмента %s: %s", tool_name, result)
         return (tool_id, result)
     
-    tasks = [execute_tool_async(tc) for tc in state.tool_calls]
-    results = await asyncio.gather(*tasks)
-    state.tool_results = {id_: res for id_, res in results if id_ is not None}
+    if len(state.tool_calls) == 1:
+        # Обычный случай - один инструмент: без gather и лишней задачи
+        try:
+            results = [await execute_tool_async(state.tool_calls[0])]
+        except Exception as e:
+            results = [e]
+    else:
+        # Ошибка одного инструмента не отменяет результаты остальных
+        results = await asyncio.gather(*(execute_tool_async(tc) for tc in state.tool_calls), return_exceptions=True)
+    tool_results = {}
+    for res in results:
+        if isinstance(res, BaseException):
+            log.error("Ошибка инструмента: %s", res)
+        elif res is not None:
+            tool_results[res[0]] = res[1]
+    state.tool_results = tool_results
     
-    perf.end("tools")
     return state
 
+@perf.timed("tool_results")
 async def tool_results_processor(state: AgentState) -> AgentState:
     if not state.tool_results:
         return state
     
-    perf.start("tool_results")
-    
-    if len(state.tool_results) == 1:
-        result = next(iter(state.tool_results.values()))
-    else:
-        result = "\n".join(str(r) for r in state.tool_results.values())
-    
-    state.text = TextMsg(str(result))
+    # Инструменты mqtt_tools возвращают готовые строки; join одного элемента возвращает его же
+    responses = [r for r in state.tool_results.values() if isinstance(r, str) and r]
+    state.text = TextMsg(". ".join(responses) if responses else "Команда выполнена")
     state.tool_calls = None
     state.tool_results = None
     
-    perf.end("tool_results")
+    if TTS_FRAGMENTS:
+        audio_bytes = fragment_tts(state.text.text)
+        if audio_bytes:
+            state.audio = AudioMsg(audio_bytes, sr=48000)
+    
     return state
 
+@perf.timed("tts")
 async def tts_node(state: AgentState) -> AgentState:
-    perf.start("tts")
-    if state.text:
+    # Аудио уже могло быть синтезировано потоково в llm_node или отправлено клиенту по частям
+    streamed = state.audio_sink is not None and state.audio_sink.started
+    if state.text and state.audio is None and not streamed:
         try:
-            audio_bytes = await tts_client(state.text.text)
+            # Постоянные фразы (ошибки, подтверждения) уже синтезированы заранее
+            audio_bytes = tts_fragment_cache.get(state.text.text) or await tts_client(state.text.text)
             state.audio = AudioMsg(audio_bytes, sr=48000)
         except Exception as e:
-            print(f"[ERROR] TTS error: {e}")
-    perf.end("tts")
+            log.error("TTS error: %s", e)
+    if state.response_key and state.text and state.audio:
+        response_cache[state.response_key] = (state.text, state.audio)
+        if semantic_cache:
+            await semantic_cache.add(state.response_key, (state.text, state.audio))
+        state.response_key = None
     return state
 
 # Маршрутизаторы
 def parsing_router(state: AgentState) -> Literal["tools", "llm", "tts"]:
     """Маршрутизатор после парсинга"""
+    if state.is_reply:
+        # Готовый ответ сразу озвучивается
+        return "tts"
     if state.tool_calls:
         return "tools"
     elif state.text:
@@ -418,128 +971,218 @@ def tools_router(state: AgentState) -> Literal["tool_results_processor", "tts"]:
         return "tool_results_processor"
     return "tts"
 
-# Построение графа
-workflow = StateGraph(AgentState)
-workflow.add_node("stt", stt_node)
-workflow.add_node("intelligent_parsing", intelligent_parsing_node)
-workflow.add_node("llm", llm_node)
-workflow.add_node("tools", tools_node)
-workflow.add_node("tool_results_processor", tool_results_processor)
-workflow.add_node("tts", tts_node)
-
-workflow.add_edge(START, "stt")
-workflow.add_edge("stt", "intelligent_parsing")
-workflow.add_conditional_edges("intelligent_parsing", parsing_router, 
-                               {"tools": "tools", "llm": "llm", "tts": "tts"})
-workflow.add_edge("llm", "tts")
-workflow.add_conditional_edges("tools", tools_router, 
-                               {"tool_results_processor": "tool_results_processor", "tts": "tts"})
-workflow.add_edge("tool_results_processor", "tts")
-workflow.add_edge("tts", END)
-
-app = workflow.compile()
+async def run_pipeline(state: AgentState) -> AgentState:
+    """Прямой вызов узлов в порядке графа: stt -> парсинг -> (инструменты | LLM) -> tts"""
+    state = await stt_node(state)
+    state = await intelligent_parsing_node(state)
+    route = parsing_router(state)
+    if route == "tools":
+        state = await tools_node(state)
+        if tools_router(state) == "tool_results_processor":
+            state = await tool_results_processor(state)
+    elif route == "llm":
+        state = await llm_node(state)
+    return await tts_node(state)
+
+# LangGraph оставлен за флагом на случай, если граф станет нелинейным
+USE_LANGGRAPH = os.getenv("USE_LANGGRAPH", "false").lower() == "true"
+
+if USE_LANGGRAPH:
+    from langgraph.graph import StateGraph, START, END
+    
+    # Построение графа
+    workflow = StateGraph(AgentState)
+    workflow.add_node("stt", stt_node)
+    workflow.add_node("intelligent_parsing", intelligent_parsing_node)
+    workflow.add_node("llm", llm_node)
+    workflow.add_node("tools", tools_node)
+    workflow.add_node("tool_results_processor", tool_results_processor)
+    workflow.add_node("tts", tts_node)
+    
+    workflow.add_edge(START, "stt")
+    workflow.add_edge("stt", "intelligent_parsing")
+    workflow.add_conditional_edges("intelligent_parsing", parsing_router, 
+                                   {"tools": "tools", "llm": "llm", "tts": "tts"})
+    workflow.add_edge("llm", "tts")
+    workflow.add_conditional_edges("tools", tools_router, 
+                                   {"tool_results_processor": "tool_results_processor", "tts": "tts"})
+    workflow.add_edge("tool_results_processor", "tts")
+    workflow.add_edge("tts", END)
+    
+    app = workflow.compile()
+
+def final_state(result) -> AgentState:
+    """Приводит результат app.ainvoke (словарь полей состояния) к AgentState"""
+    return result if isinstance(result, AgentState) else AgentState(**result)
+
+async def invoke_pipeline(state: AgentState) -> AgentState:
+    with perf.turn():
+        if USE_LANGGRAPH:
+            return final_state(await app.ainvoke(state))
+        return await run_pipeline(state)
 
 # WebSocket сервер и остальной код остается без изменений...
 HOST, PORT = os.getenv("MAGUS_WS_HOST", "0.0.0.0"), int(os.getenv("MAGUS_WS_PORT", 8765))
+# Максимальный размер одного высказывания от клиента
+MAX_AUDIO_BYTES = int(os.getenv("MAX_AUDIO_BYTES", 8*2**20))
+
+# Команда конца высказывания. Клиент шлет ровно "END"; проверка по множеству без upper()/strip()
+END_COMMANDS = frozenset({"END", "end", "End"})
+
+# compression=None: permessage-deflate ничего не дает на PCM/WAV, но тратит CPU и ~50 КБ памяти на соединение
+WS_SERVE_KWARGS = dict(max_size=8*2**20, max_queue=4, compression=None, ping_interval=300, ping_timeout=None)
+
+# Размер фрагмента при отправке длинного ответа: лимит клиента (max_size) действует на сообщение
+# целиком, а не на фрагмент, так что крупные фрагменты просто уменьшают число кадров и await
+AUDIO_FRAGMENT_SIZE = int(os.getenv("AUDIO_FRAGMENT_SIZE", 4*2**20))
+
+# Порог RMS по int16 PCM: тишина и фоновый шум не доходят до STT. По умолчанию выключен (0):
+# высказывание уже прошло VAD клиента
+SILENCE_RMS = float(os.getenv("SILENCE_RMS", "0"))
+SILENCE_WINDOW = 480  # 30 мс при 16 кГц
+
+def is_silence(pcm) -> bool:
+    """Тишина, если громкость ни одного 30-мс окна не достигает порога: паузы в тихой речи не в счет"""
+    if SILENCE_RMS <= 0 or len(pcm) < 2:
+        return False
+    samples = np.frombuffer(pcm, dtype=np.int16, count=len(pcm) // 2).astype(np.float32)
+    n = samples.size // SILENCE_WINDOW * SILENCE_WINDOW or samples.size
+    frames = samples[:n].reshape(-1, min(SILENCE_WINDOW, n))
+    return float(np.sqrt((frames * frames).mean(axis=1).max())) < SILENCE_RMS
+
+def split_audio_data(audio_data: bytes, max_chunk_size: int = AUDIO_FRAGMENT_SIZE):
+    """Отдает фрагменты аудио как memoryview-срезы без копирования данных"""
+    mv = memoryview(audio_data)
+    for i in range(0, len(mv), max_chunk_size):
+        yield mv[i:i + max_chunk_size]
+
+async def process_utterance(ws, audio_data, stream: bool = False):
+    """Прогоняет одно высказывание через граф и отправляет аудио-ответ клиенту"""
+    sink = AudioStream(ws) if stream else None
+    state = AgentState(audio=AudioMsg(audio_data), audio_sink=sink)
+    try:
+        final = await invoke_pipeline(state)
+        
+        # Логируем статистику
+        if final.parse_method:
+            log.info("[STATS] Метод: %s, Уверенность: %.2f", final.parse_method, final.confidence or 0.0)
+        
+        if sink and sink.started:
+            # Ответ уже ушел клиенту по предложениям
+            await sink.end()
+            return
+        
+        audio_result = final.audio
+        if audio_result is None and final.text:
+            audio_result = AudioMsg(await tts_client(final.text.text), sr=48000)
+        
+        if audio_result:
+            if len(audio_result.raw) > AUDIO_FRAGMENT_SIZE:
+                # Одно фрагментированное сообщение: клиент получает его целиком одним recv()
+                await ws.send(split_audio_data(audio_result.raw))
+            else:
+                await ws.send(audio_result.raw)
+        else:
+            await ws.send(b"RIFF$\x00\x00\x00WAVEfmt \x10\x00\x00\x00\x01\x00\x01\x00\x80>\x00\x00\x00}\x00\x00\x02\x00\x10\x00data\x00\x00\x00\x00")
+        
+    except Exception as e:
+        log.error("Processing error: %s", e)
+        if sink and sink.started:
+            # Клиент уже проигрывает часть ответа: закрываем поток, ошибка только в лог
+            await sink.end()
+        else:
+            await ws.send(f"ERROR: {e}")
 
-def split_audio_data(audio_data: bytes, max_chunk_size: int = 1024 * 1024) -> list:
-    return [audio_data[i:i + max_chunk_size] for i in range(0, len(audio_data), max_chunk_size)]
+async def worker(worker_id: int):
+    """Обработчик очереди высказываний. Несколько воркеров работают параллельно"""
+    while True:
+        ws, audio_data, stream = await work_queue.get()
+        try:
+            await process_utterance(ws, audio_data, stream)
+        except Exception as e:
+            # Клиент мог отключиться, пока шла обработка
+            log.error("Worker %d: %s", worker_id, e)
+        finally:
+            work_queue.task_done()
 
 async def handle(ws):
-    audio_chunks = []
+    # Аудио накапливается в одном буфере по мере прихода, поэтому на END склейка не нужна
+    audio_buf = bytearray()
+    oversize = False  # высказывание превысило лимит, кадры отбрасываются до END
+    stream = False  # клиент принимает ответ по предложениям
     try:
         async for msg in ws:
             if isinstance(msg, bytes):
-                audio_chunks.append(msg)
-            elif isinstance(msg, str) and msg.strip().upper() == "END":
-                if processing_lock.locked():
-                    await ws.send("BUSY")
-                    audio_chunks = []
+                if oversize:
                     continue
-                
-                audio_data = b"".join(audio_chunks)
+                if not audio_buf:
+                    # Начало высказывания: пока приходит аудио, поднимаем соединение со STT
+                    task = asyncio.create_task(stt_ws.ensure())
+                    background_tasks.add(task)
+                    task.add_done_callback(background_tasks.discard)
+                if len(audio_buf) + len(msg) > MAX_AUDIO_BYTES:
+                    oversize = True
+                    audio_buf.clear()
+                    await ws.send("ERROR: audio too large")
+                    continue
+                audio_buf += msg
+            elif isinstance(msg, str) and msg.rstrip() in END_COMMANDS:
+                if oversize:
+                    oversize = False
+                    continue
+                # Отдаем буфер в обработку без копирования и начинаем новый
+                audio_data, audio_buf = audio_buf, bytearray()
                 if not audio_data:
                     await ws.send("ERROR: No audio data")
                     continue
+                if is_silence(audio_data):
+                    await ws.send("SILENCE")
+                    continue
                 
-                async with processing_lock:
-                    state = AgentState(audio=AudioMsg(audio_data))
-                    try:
-                        result = await app.ainvoke(state)
-                        
-                        # Логируем статистику
-                        if hasattr(result.get('intelligent_parsing'), 'parse_method'):
-                            method = result['intelligent_parsing'].parse_method
-                            confidence = result['intelligent_parsing'].confidence
-                            print(f"[STATS] Метод: {method}, Уверенность: {confidence:.2f}")
-                        
-                        audio_result = None
-                        for value in dict(result).values():
-                            if hasattr(value, 'audio') and value.audio:
-                                audio_result = value.audio
-                                break
-                        
-                        if not audio_result:
-                            for value in dict(result).values():
-                                text_to_speak = None
-                                if hasattr(value, 'text') and value.text:
-                                    text_to_speak = value.text.text if hasattr(value.text, 'text') else value.text
-                                elif isinstance(value, str):
-                                    text_to_speak = value
-                                elif isinstance(value, TextMsg):
-                                    text_to_speak = value.text
-                                
-                                if text_to_speak:
-                                    audio_bytes = await tts_client(text_to_speak)
-                                    audio_result = AudioMsg(audio_bytes, sr=48000)
-                                    break
-                        
-                        if audio_result:
-                            if len(audio_result.raw) > 1024 * 1024:
-                                await ws.send("AUDIO_CHUNKS_BEGIN")
-                                for chunk in split_audio_data(audio_result.raw):
-                                    await ws.send(chunk)
-                                await ws.send("AUDIO_CHUNKS_END")
-                            else:
-                                await ws.send(audio_result.raw)
-                        else:
-                            await ws.send(b"RIFF$\x00\x00\x00WAVEfmt \x10\x00\x00\x00\x01\x00\x01\x00\x80>\x00\x00\x00}\x00\x00\x02\x00\x10\x00data\x00\x00\x00\x00")
-                        
-                    except Exception as e:
-                        print(f"[ERROR] Processing error: {e}")
-                        await ws.send(f"ERROR: {e}")
-                
-                audio_chunks = []
+                try:
+                    work_queue.put_nowait((ws, audio_data, stream))
+                except asyncio.QueueFull:
+                    await ws.send("BUSY")
+            elif msg == AUDIO_STREAM_HELLO:
+                # Объявление возможностей клиента, ответ не нужен
+                stream = STREAM_TTS
             else:
                 await ws.send("ACK")
     except Exception as e:
-        print(f"[ERROR] WebSocket error: {e}")
+        log.error("WebSocket error: %s", e)
 
 async def main_ws():
     await preload_models()
-    print(f"[WS] Serving on ws://{HOST}:{PORT}")
-    print(f"[CONFIG] Performance mode: {PERFORMANCE_MODE}")
-    print(f"[CONFIG] LLM fallback: {USE_LLM_FALLBACK}")
-    print(f"[CONFIG] Confidence threshold: {CONFIDENCE_THRESHOLD}")
+    # Храним ссылки на задачи, чтобы их не собрал GC
+    workers = [asyncio.create_task(worker(i)) for i in range(N_WORKERS)]
+    if LLM_WARMUP:
+        # Сервер стартует сразу, LLM прогревается в фоне
+        workers.append(asyncio.create_task(llm_warmup_loop()))
+    if TTS_FRAGMENTS:
+        workers.append(asyncio.create_task(prewarm_tts_fragments()))
+    log.info("[WS] Serving on ws://%s:%d", HOST, PORT)
+    log.info("[CONFIG] Performance mode: %s", PERFORMANCE_MODE)
+    log.info("[CONFIG] LLM fallback: %s", USE_LLM_FALLBACK)
+    log.info("[CONFIG] Confidence threshold: %s", CONFIDENCE_THRESHOLD)
     
     try:
-        async with websockets.serve(handle, HOST, PORT, max_size=8*2**20, ping_interval=300, ping_timeout=None):
-            print(f"[WS] WebSocket server started successfully on {HOST}:{PORT}")
+        async with websockets.serve(handle, HOST, PORT, **WS_SERVE_KWARGS):
+            log.info("[WS] WebSocket server started successfully on %s:%d", HOST, PORT)
             await asyncio.Future()
     except OSError as e:
         if e.errno == 10048:
-            print(f"[ERROR] Port {PORT} is already in use. Trying alternative ports...")
+            log.error("Port %d is already in use. Trying alternative ports...", PORT)
             for alt_port in range(PORT + 1, PORT + 10):
                 try:
-                    async with websockets.serve(handle, HOST, alt_port, max_size=8*2**20, ping_interval=300, ping_timeout=None):
-                        print(f"[WS] WebSocket server started on alternative port {HOST}:{alt_port}")
-                        print(f"[WS] Update your client to connect to port {alt_port}")
+                    async with websockets.serve(handle, HOST, alt_port, **WS_SERVE_KWARGS):
+                        log.info("[WS] WebSocket server started on alternative port %s:%d", HOST, alt_port)
+                        log.info("[WS] Update your client to connect to port %d", alt_port)
                         await asyncio.Future()
                         break
                 except OSError:
                     continue
             else:
-                print(f"[ERROR] Could not bind to any port in range {PORT}-{PORT+9}")
+                log.error("Could not bind to any port in range %d-%d", PORT, PORT + 9)
                 raise e
         else:
             raise e
@@ -549,9 +1192,11 @@ async def cli_loop():
     print(f"[CLI] Режим производительности: {PERFORMANCE_MODE}")
     print(f"[CLI] Введите 'stats' для просмотра статистики\n")
     
+    loop = asyncio.get_running_loop()
     while True:
         try:
-            user_input = input("Вы: ").strip()
+            # input() блокирует, поэтому читаем в потоке и не останавливаем event loop
+            user_input = (await loop.run_in_executor(None, input, "Вы: ")).strip()
             if user_input.lower() in ("exit", "quit", "выход"):
                 print("[CLI] Завершение работы.")
                 break
@@ -563,19 +1208,8 @@ async def cli_loop():
                 continue
             
             state = AgentState(text=TextMsg(user_input))
-            result = await app.ainvoke(state)
-            
-            response_text = None
-            for value in dict(result).values():
-                if hasattr(value, 'text') and value.text:
-                    response_text = value.text.text if hasattr(value.text, 'text') else value.text
-                elif isinstance(value, str):
-                    response_text = value
-                elif isinstance(value, TextMsg):
-                    response_text = value.text
-                
-                if response_text:
-                    break
+            final = await invoke_pipeline(state)
+            response_text = final.text.text if final.text else None
             
             print(f"Ассистент: {response_text or '[Нет ответа]'}")
                 
@@ -586,6 +1220,13 @@ async def cli_loop():
 if __name__ == "__main__":
     import sys
     
+    # uvloop (libuv) вместо стандартного event loop, где он доступен (Linux/aarch64)
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    
     if len(sys.argv) > 1 and sys.argv[1] == "--cli":
         print("[INFO] Запуск в CLI режиме")
         try:
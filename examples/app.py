@@ -1,5 +1,8 @@
+import asyncio
 import os
-import json
+import orjson
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import paho.mqtt.client as mqtt
 from fastapi import FastAPI, Request
 from langchain.callbacks.manager import CallbackManager
@@ -8,18 +11,28 @@ from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 
 app = FastAPI()
 
-# Глобальные переменные: модель LLM и история диалога
+# Глобальные переменные: модель LLM, история диалога и MQTT-клиент
 llm = None
-conversation_history = []
+conversation_history = deque(maxlen=10)  # последние 10 обменов, старые вытесняются сами
+mqtt_client = None
 
 # Адрес Rhasspy
 RHASSPY_URL = "http://localhost:12101"
 
+# Генерация llama.cpp блокирует поток на секунды: выполняем ее вне event loop.
+# Один поток, так как модель не допускает параллельных вызовов
+llm_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm")
+
+# На ARMv8 одноплатниках нет SMT: логических ядер столько же, сколько физических
+LLM_THREADS = int(os.getenv("LLM_THREADS", os.cpu_count() or 4))
+
 # Системный промпт для модели
 system_prompt = """You are a knowledgeable, efficient, and direct AI assistant. Provide concise answers, focusing on the key information needed.
 Offer suggestions tactfully when appropriate to improve outcomes. Engage in productive collaboration with the user.
 Speak only russian language. Write only in one language.
 """
+# Начало промпта одинаково во всех запросах: llama.cpp не пересчитывает KV-кэш для совпадающего префикса
+SYSTEM_PREFIX = system_prompt + "\n\n"
 
 def init_llm(model_path: str = "./models/Llama-3.2-3B-Instruct-Q8_0.gguf"):
     """
@@ -35,14 +48,20 @@ def init_llm(model_path: str = "./models/Llama-3.2-3B-Instruct-Q8_0.gguf"):
         "Human:", "User:", "Assistant:", "System:"
     ]
     
+    # NEON/dotprod ядра llama.cpp включаются при сборке колеса:
+    # CMAKE_ARGS="-DGGML_NATIVE=ON" pip install --no-binary llama-cpp-python llama-cpp-python
     _llm = LlamaCpp(
         model_path=model_path,
         temperature=0.2,
         max_tokens=256,
         n_ctx=1024,
         n_batch=512,
+        n_threads=LLM_THREADS,
+        model_kwargs={"n_threads_batch": LLM_THREADS},  # разбор промпта тоже на всех ядрах
         callback_manager=callback_manager,
-        use_mlock=True,
+        # Q8_0 модель занимает больше 3 ГБ: mlock на плате с 4 ГБ приводит к OOM, страницы отдает mmap
+        use_mmap=True,
+        use_mlock=False,
         verbose=False,
         seed=42,
         stop=stop_sequences,
@@ -56,20 +75,34 @@ def init_llm(model_path: str = "./models/Llama-3.2-3B-Instruct-Q8_0.gguf"):
 @app.on_event("startup")
 def startup_event():
     """
-    При старте приложения инициализируется LLM.
+    При старте приложения инициализируются LLM и MQTT-соединение.
     """
-    global llm
+    global llm, mqtt_client
     model_path = os.getenv("LLM_MODEL_PATH", "./models/Llama-3.2-3B-Instruct-Q8_0.gguf")
     llm = init_llm(model_path=model_path)
+    mqtt_client = init_mqtt()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    mqtt_client.loop_stop()
+    mqtt_client.disconnect()
+
+def init_mqtt() -> mqtt.Client:
+    """
+    Одно MQTT-соединение на все время работы: сетевой поток paho держит его
+    и переподключается сам, публикация не ждет рукопожатия.
+    """
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    client.connect_async("localhost", 1883, 60)
+    client.loop_start()
+    return client
 
 def speak_text_in_rhasspy(answer: str):
     """
     Отправляет текст для озвучивания через диалоговую систему Rhasspy
     """
-    client = mqtt.Client()
     try:
-        client.connect("localhost", 1883, 60)
-        
         # Формируем сообщение для управления диалогом
         payload = {
             "siteId": "default",
@@ -81,9 +114,9 @@ def speak_text_in_rhasspy(answer: str):
         
         # Публикуем сообщение
         print(f"Отправка через MQTT диалог: {payload}")
-        client.publish("hermes/dialogueManager/startSession", json.dumps(payload))
-        client.disconnect()
-        print("Сообщение успешно отправлено через MQTT диалог")
+        # publish только ставит сообщение в очередь, отправляет его поток paho
+        mqtt_client.publish("hermes/dialogueManager/startSession", orjson.dumps(payload))
+        print("Сообщение поставлено в очередь MQTT диалога")
     except Exception as e:
         print(f"Ошибка при отправке через MQTT диалог: {str(e)}")
 
@@ -99,7 +132,6 @@ async def recognize(request: Request):
        "raw_text": "Как дела?"
     }
     """
-    global conversation_history
     data = await request.json()
     raw_text = data.get("raw_text", "")
     intent = data.get("intent", {}).get("name", "")
@@ -115,14 +147,12 @@ async def recognize(request: Request):
         return {"status": "skipped", "reason": f"Интент '{intent}' не требует генерации ответа."}
 
     # Формируем полный промпт: системный промпт, история (если есть), новый ввод
-    prompt = system_prompt + "\n\n"
-    if conversation_history:
-        prompt += "\n".join(conversation_history) + "\n"
-    prompt += f"User: {raw_text}\nAssistant:"
+    # Части собираются одним join, без промежуточных строк на каждом +=
+    prompt = "".join((SYSTEM_PREFIX, *(f"{turn}\n" for turn in conversation_history), f"User: {raw_text}\nAssistant:"))
 
     print("Получен запрос:", raw_text)
     try:
-        response = llm.invoke(prompt)
+        response = await asyncio.get_running_loop().run_in_executor(llm_pool, llm.invoke, prompt)
         # Если в ответе есть стоп-маркеры, отсекаем их
         stop_markers = ["<|eot_id|>", "<|end_of_text|>"]
         for marker in stop_markers:
@@ -130,10 +160,8 @@ async def recognize(request: Request):
                 response = response.split(marker)[0].strip()
         print("Ответ модели:", response)
         
-        # Обновляем историю диалога (ограничиваем до 10 записей)
+        # Обновляем историю диалога (deque сам держит не больше 10 записей)
         conversation_history.append(f"User: {raw_text}\nAssistant: {response}")
-        if len(conversation_history) > 10:
-            conversation_history.pop(0)
         
         # Отправляем ответ на Rhasspy для озвучивания
         speak_text_in_rhasspy(response)
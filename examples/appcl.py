@@ -1,27 +1,103 @@
+import asyncio
 import os
-import json
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import paho.mqtt.client as mqtt
 from fastapi import FastAPI, Request
 from langchain_community.llms import LlamaCpp
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from pydantic import BaseModel, Field
 from typing import Optional, List
-from langchain_core.output_parsers import StrOutputParser, PydanticOutputParser
+from langchain_core.output_parsers import StrOutputParser
 from langchain.prompts import PromptTemplate
 
 app = FastAPI()
 
-# Глобальные переменные: модель LLM и история диалога
+# Глобальные переменные: модель LLM, классификатор по эмбеддингам и MQTT-клиент
 llm = None
+embedder = None
+centroids = None
+mqtt_client = None
 
 # Адрес Rhasspy
 RHASSPY_URL = "http://localhost:12101"
 
+# Квантизация GGUF классификатора. Для выбора из пяти меток хватает Q4_K_M: весов вдвое меньше,
+# чем у Q8_0, а генерация на CPU упирается в пропускную способность памяти
+LLM_QUANT = os.getenv("LLM_QUANT", "Q4_K_M")
+DEFAULT_MODEL_PATH = f"./models/Llama-3.2-3B-Instruct-{LLM_QUANT}.gguf"
+
+# Быстрый классификатор: эмбеддинг фразы сравнивается с центроидами примеров каждой категории.
+# LLM вызывается только если сходство ниже порога
+EMBED_CLASSIFIER = os.getenv("EMBED_CLASSIFIER", "true").lower() == "true"
+EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+EMBED_THRESHOLD = float(os.getenv("EMBED_THRESHOLD", "0.5"))
+CATEGORY_EXAMPLES = {
+    "weather": ["какая сегодня погода", "нужен ли зонт", "сколько градусов на улице", "будет ли дождь завтра", "what's the weather like"],
+    "music": ["включи музыку", "поставь песню", "следующий трек", "включи что-нибудь из рока", "play some music"],
+    "time": ["который час", "какое сегодня число", "какой сегодня день недели", "сколько времени", "what time is it"],
+    "about work": ["какие у меня встречи сегодня", "напомни про совещание", "что по задачам на работе", "когда созвон с коллегами", "do I have meetings today"],
+    "general question": ["как дела", "расскажи анекдот", "кто написал войну и мир", "почему небо голубое", "tell me something interesting"],
+}
+CATEGORY_LABELS = list(CATEGORY_EXAMPLES)
+
+# GBNF-грамматика llama.cpp: модель может выдать только {"category":"<метка>"},
+# ответ занимает десяток токенов и всегда разбирается
+CATEGORY_GRAMMAR = 'root ::= "{\\"category\\":\\"" cat "\\"}"\ncat ::= ' + " | ".join(f'"{label}"' for label in CATEGORY_LABELS)
+
+def init_classifier():
+    """Загружает модель эмбеддингов и считает нормализованные центроиды категорий"""
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(EMBED_MODEL)
+    rows = []
+    for label in CATEGORY_LABELS:
+        emb = model.encode(CATEGORY_EXAMPLES[label], normalize_embeddings=True).mean(axis=0)
+        rows.append(emb / np.linalg.norm(emb))
+    return model, np.asarray(rows, dtype=np.float32)
+
+def classify_by_embedding(text: str) -> Optional[str]:
+    """Категория по ближайшему центроиду или None, если сходство ниже порога"""
+    sims = centroids @ embedder.encode(text, normalize_embeddings=True).astype(np.float32)
+    best = int(sims.argmax())
+    return CATEGORY_LABELS[best] if sims[best] >= EMBED_THRESHOLD else None
+
 class Category(BaseModel):
     category: Optional[str] = Field(default=None, description="The category of the message if you know")
 
-
-def init_llm(model_path: str = "./models/Llama-3.2-3B-Instruct-Q8_0.gguf"):
+def parse_category(text: str) -> Category:
+    """Ответ ограничен грамматикой, поэтому достаточно одного разбора JSON"""
+    return Category(**orjson.loads(text))
+
+# Промпт и цепочка не зависят от запроса: собираются один раз.
+# Короткий статический промпт: метки видны в грамматике, длинные описания только удлиняют разбор.
+# Переменная часть стоит в конце, llama.cpp переиспользует KV-кэш совпадающего префикса между запросами
+prompt_template = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
+Classify the smart speaker user's message (any language) by meaning into one category:
+"weather" - weather, rain, temperature, forecast;
+"music" - songs, playback, tracks;
+"time" - time, date, day, calendar;
+"about work" - tasks, meetings, colleagues;
+"general question" - anything else.
+Output ONLY JSON: {{"category": "<category>"}}<|eot_id|><|start_header_id|>user<|end_header_id|>
+{text_input}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
+"""
+
+prompt = PromptTemplate(
+    template=prompt_template,
+    input_variables=["text_input"],
+)
+chain = None
+
+# chain.invoke синхронный: пока модель выбирает категорию, event loop принимает другие запросы.
+# Экземпляр Llama один на сервис, поэтому классификации идут по очереди в одном потоке
+llm_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm")
+
+# Потоки llama.cpp для классификатора, по умолчанию все ядра. Лучшее значение для платы: llama-bench -t 2,4,6,8
+LLM_THREADS = int(os.getenv("LLM_THREADS", os.cpu_count() or 4))
+
+
+def init_llm(model_path: str = DEFAULT_MODEL_PATH):
     """
     Инициализация модели LlamaCpp с базовыми настройками.
     """
@@ -38,11 +114,17 @@ def init_llm(model_path: str = "./models/Llama-3.2-3B-Instruct-Q8_0.gguf"):
     _llm = LlamaCpp(
         model_path=model_path,
         temperature=0.2,
-        max_tokens=128,
+        max_tokens=24,
+        grammar=CATEGORY_GRAMMAR,
         n_ctx=1024,
-        n_batch=512,
+        n_batch=128,  # промпт короткий, большой батч разбора не нужен
+        n_threads=LLM_THREADS,
+        model_kwargs={"n_threads_batch": LLM_THREADS},  # основное время классификации уходит на разбор промпта
+        n_gpu_layers=0,
         callback_manager=callbacks,
-        use_mlock=True,
+        # Веса отображаются из файла без второй копии в RAM. mlock всей модели на плате с 4 ГБ приводит к OOM
+        use_mmap=True,
+        use_mlock=False,
         verbose=False,
         seed=42,
         stop=stop_sequences,
@@ -56,20 +138,42 @@ def init_llm(model_path: str = "./models/Llama-3.2-3B-Instruct-Q8_0.gguf"):
 @app.on_event("startup")
 def startup_event():
     """
-    При старте приложения инициализируется LLM.
+    При старте приложения инициализируются LLM, цепочка классификации,
+    классификатор по эмбеддингам и MQTT-соединение.
     """
-    global llm
-    model_path = os.getenv("LLM_MODEL_PATH", "./models/Llama-3.2-3B-Instruct-Q8_0.gguf")
+    global llm, chain, embedder, centroids, mqtt_client
+    model_path = os.getenv("LLM_MODEL_PATH", DEFAULT_MODEL_PATH)
     llm = init_llm(model_path=model_path)
+    chain = prompt | llm | StrOutputParser() | parse_category
+    if EMBED_CLASSIFIER:
+        try:
+            embedder, centroids = init_classifier()
+            print("Классификатор по эмбеддингам загружен!")
+        except Exception as e:
+            print(f"Классификатор по эмбеддингам отключен: {e}")
+    mqtt_client = init_mqtt()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    mqtt_client.loop_stop()
+    mqtt_client.disconnect()
+
+def init_mqtt() -> mqtt.Client:
+    """
+    Клиент создается при старте сервиса и закрывается в shutdown_event.
+    Если брокер Rhasspy перезапустится, paho переподключится с паузой от 1 до 30 секунд.
+    """
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
+    client.connect_async("localhost", 1883, 60)
+    client.loop_start()
+    return client
 
 def speak_text_in_rhasspy(answer: str):
     """
     Отправляет текст для озвучивания через диалоговую систему Rhasspy
     """
-    client = mqtt.Client()
     try:
-        client.connect("localhost", 1883, 60)
-        
         # Формируем сообщение для управления диалогом
         payload = {
             "siteId": "default",
@@ -81,9 +185,9 @@ def speak_text_in_rhasspy(answer: str):
         
         # Публикуем сообщение
         print(f"Отправка через MQTT диалог: {payload}")
-        client.publish("hermes/dialogueManager/startSession", json.dumps(payload))
-        client.disconnect()
-        print("Сообщение успешно отправлено через MQTT диалог")
+        # Сообщение уходит из фонового потока paho, обработчик не ждет брокер
+        mqtt_client.publish("hermes/dialogueManager/startSession", orjson.dumps(payload))
+        print("Сообщение поставлено в очередь MQTT диалога")
     except Exception as e:
         print(f"Ошибка при отправке через MQTT диалог: {str(e)}")
 
@@ -99,43 +203,6 @@ async def recognize(request: Request):
        "raw_text": "Как дела?"
     }
     """
-    parser = PydanticOutputParser(pydantic_object=Category)
-
-    prompt_template = """
-    <|begin_of_text|><|start_header_id|>system<|end_header_id|>
-    You are an expert assistant for classifying user messages for a smart speaker.
-
-    AVAILABLE CATEGORIES:
-    1. "weather" – For any text related to weather information, including inquiries about rain, umbrella necessity, temperature, precipitation, forecasts, climate conditions, or similar topics.
-    2. "music" – For any text regarding songs, music playback, track selection, music style requests, or any other music-related inquiries.
-    3. "time" – For any text concerning time, including requests about the current time, dates, days of the week, months, years, or calendar events.
-    4. "about work" – For any text related to work matters, including inquiries about tasks, meetings, office schedules, colleagues, or professional-related content.
-    5. "general question" – For texts that do not clearly fit into any of the above categories.
-
-    Note: The user's message may be in any language. Base your classification solely on its meaning.
-
-    Your task:
-    Read the user's message carefully and select the single most appropriate category from the list above.
-    Output ONLY a JSON object with the key "category", enclosed in triple backticks (```json ... ```). Do not include any additional text or explanation.
-
-    <|eot_id|><|start_header_id|>user<|end_header_id|>
-    Determine the category for the following text:
-
-    {text_input}
-
-    <|eot_id|><|start_header_id|>assistant<|end_header_id|>
-    ```json
-    """
-
-
-
-
-    prompt = PromptTemplate(
-        template=prompt_template,
-        input_variables=["text_input"],
-        partial_variables={"format_instructions": parser.get_format_instructions()}
-    )
-
     # get input
     data = await request.json()
     raw_text = data.get("raw_text", "")
@@ -151,10 +218,12 @@ async def recognize(request: Request):
         print("Интент не 'False', LLM не вызывается.")
         return {"status": "skipped", "reason": f"Интент '{intent}' не требует генерации ответа."}
 
-    chain = prompt | llm | StrOutputParser() | parser
-
     try:
-        category = chain.invoke({"text_input": raw_text})
+        label = await asyncio.to_thread(classify_by_embedding, raw_text) if embedder is not None else None
+        if label:
+            category = Category(category=label)
+        else:
+            category = await asyncio.get_running_loop().run_in_executor(llm_pool, chain.invoke, {"text_input": raw_text})
     
         print("Ответ модели:", category)  # This will print the Category object
         
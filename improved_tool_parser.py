@@ -4,7 +4,7 @@ import json
 from typing import Optional, List, Dict, Any
 from dataclasses import dataclass
 
-@dataclass
+@dataclass(slots=True)
 class ToolCall:
     name: str
     args: Dict[str, Any]
@@ -64,9 +64,12 @@ class OptimizedToolParser:
                 "patterns": [
                     r"(?:поставь|установи|засеки|включи|запусти)\s+таймер",
                     r"таймер\s+на\s+(\d+|\w+)",
-                    r"(\d+|\w+)\s+(?:минут|мин|секунд|сек|час)",
+                    r"засеки\s+(\d+|\w+)\s+(?:минут|мин|секунд|сек|час)",
                     r"timer\s+(?:for\s+)?(\d+)"
                 ],
+                # Длительность встречается и в обычной речи ("буду через пять минут"):
+                # без слова таймера кандидата нет
+                "requires_keyword": True,
                 "priority": 4,
                 "confidence_boost": 0.2
             },
@@ -94,6 +97,34 @@ class OptimizedToolParser:
             }
         }
         
+        # Паттерны инструмента объединены в одно выражение: один проход вместо поиска по каждому
+        self.compiled_patterns = {
+            tool_name: re.compile("|".join(f"(?:{p})" for p in config["patterns"]), re.IGNORECASE)
+            for tool_name, config in self.tool_patterns.items()
+        }
+        self.action_tag_pattern = re.compile(r'\[([^\]]+)\]\s*(.+)', re.IGNORECASE)
+        self.action_map = {
+            "время": "get_time", "таймер": "set_timer", 
+            "напоминание": "set_notification", "погода": "get_weather",
+            "звонок": "call_contact"
+        }
+        # Экстракторы аргументов по имени инструмента: словарь вместо цепочки if/elif
+        self.arg_extractors = {
+            "set_timer": self._extract_timer_args,
+            "set_notification": self._extract_notification_args,
+            "call_contact": self._extract_call_args,
+        }
+        # Обращение к себе вместо имени контакта
+        self.self_pronouns = {"мне", "меня", "нам", "нас", "me"}
+        # Значения, если обязательный аргумент не найден. При прямом парсинге такая фраза уходит в LLM
+        self.arg_defaults = {
+            "set_timer": {"minutes": 1},
+            "call_contact": {"contact_name": "неизвестный контакт"},
+        }
+        # Слова, снимающие конфликт время/погода: одно выражение вместо проверки каждого слова
+        self.time_only_pattern = re.compile("только время|сколько время|который час|час сейчас")
+        self.weather_only_pattern = re.compile("температура|погода|дождь|солнце|облачно|ясно|снег|ветер")
+        
         # Минимальная уверенность для выполнения инструмента
         self.min_confidence = 0.4
         
@@ -150,19 +181,25 @@ class OptimizedToolParser:
             
             # Проверяем ключевые слова
             keyword_matches = sum(1 for keyword in config["keywords"] if keyword in text)
+            if not keyword_matches and config.get("requires_keyword"):
+                continue
             confidence += keyword_matches * 0.3
             
             # Проверяем паттерны
-            for pattern in config["patterns"]:
-                if re.search(pattern, text, re.IGNORECASE):
-                    confidence += 0.5
-                    break
+            if self.compiled_patterns[tool_name].search(text):
+                confidence += 0.5
+            
+            # Без ключевых слов и паттернов инструмент не подходит: один boost не дает кандидата
+            if not confidence:
+                continue
             
             # Добавляем boost уверенности
             confidence += config.get("confidence_boost", 0)
             
             if confidence >= 0.3:
-                args = self._extract_args(tool_name, text)
+                args = self._extract_args(tool_name, text, strict=True)
+                if args is None:
+                    continue
                 matches.append(ToolCall(name=tool_name, args=args, confidence=confidence))
         
         if not matches:
@@ -175,22 +212,20 @@ class OptimizedToolParser:
         # Если есть и время и погода, применяем специальные правила
         if time_matches and weather_matches:
             # Ключевые слова только для времени
-            time_only_words = ["только время", "сколько время", "который час", "час сейчас"]
-            if any(word in text.lower() for word in time_only_words):
+            if self.time_only_pattern.search(text):
                 return [time_matches[0]]
             
             # Ключевые слова только для погоды  
-            weather_only_words = ["температура", "погода", "дождь", "солнце", "облачно", "ясно", "снег", "ветер"]
-            if any(word in text.lower() for word in weather_only_words):
+            if self.weather_only_pattern.search(text):
                 return [weather_matches[0]]
             
             # Если неоднозначно, выбираем время (так как запросы времени чаще)
             return [time_matches[0]]
         
-        # Обычная сортировка по приоритету и уверенности
+        # Сортировка по уверенности, приоритет решает при равенстве
         matches.sort(key=lambda x: (
-            self.tool_patterns[x.name].get("priority", 1),
-            x.confidence
+            x.confidence,
+            self.tool_patterns[x.name].get("priority", 1)
         ), reverse=True)
         
         return [matches[0]]
@@ -203,39 +238,30 @@ class OptimizedToolParser:
 
     def _parse_action_tags(self, text: str) -> Optional[List[ToolCall]]:
         """Парсинг по тегам [ДЕЙСТВИЕ]"""
-        action_map = {
-            "время": "get_time", "таймер": "set_timer", 
-            "напоминание": "set_notification", "погода": "get_weather",
-            "звонок": "call_contact"
-        }
-        
-        pattern = r'\[([^\]]+)\]\s*(.+)'
-        match = re.search(pattern, text, re.IGNORECASE)
+        # Теги встречаются только в ответах LLM: у обычной фразы нет '[', регулярка не нужна
+        if '[' not in text:
+            return None
+        match = self.action_tag_pattern.search(text)
         
         if match:
             action = match.group(1).lower().strip()
             description = match.group(2).strip()
             
-            if action in action_map:
-                tool_name = action_map[action]
+            tool_name = self.action_map.get(action)
+            if tool_name:
                 args = self._extract_args(tool_name, description)
                 return [ToolCall(name=tool_name, args=args, confidence=0.9)]
                 
         return None
 
-    def _extract_args(self, tool_name: str, text: str) -> Dict[str, Any]:
-        """Универсальный экстрактор аргументов"""
-        if tool_name == "get_time":
-            return {}
-        elif tool_name == "get_weather":
-            return {}
-        elif tool_name == "set_timer":
-            return self._extract_timer_args(text)
-        elif tool_name == "set_notification":
-            return self._extract_notification_args(text)
-        elif tool_name == "call_contact":
-            return self._extract_call_args(text)
-        return {}
+    def _extract_args(self, tool_name: str, text: str, strict: bool = False) -> Optional[Dict[str, Any]]:
+        """Универсальный экстрактор аргументов. strict: None, если обязательный аргумент не найден"""
+        # get_time и get_weather аргументов не имеют
+        extractor = self.arg_extractors.get(tool_name)
+        args = extractor(text) if extractor else {}
+        if not args and tool_name in self.arg_defaults:
+            return None if strict else dict(self.arg_defaults[tool_name])
+        return args
 
     def _parse_number(self, text: str) -> Optional[int]:
         """Умный парсинг чисел (цифры + текст)"""
@@ -245,8 +271,9 @@ class OptimizedToolParser:
             return int(digit_match.group(1))
         
         # Затем ищем текстовые числа
+        text = text.lower()
         for word, number in self.text_numbers.items():
-            if word in text.lower():
+            if word in text:
                 return int(number)
         
         return None
@@ -257,12 +284,14 @@ class OptimizedToolParser:
         # Сначала ищем точное совпадение
         if text in self.text_numbers:
             return int(self.text_numbers[text])
-        # Затем ищем комбинации десятков и единиц
-        parts = text.split()
+        # Число стоит перед единицей измерения: смотрим последние слова ("поставь таймер на пять")
+        parts = text.split()[-2:]
         if len(parts) == 2:
             tens, ones = parts
             if tens in self.text_numbers and ones in self.text_numbers:
                 return int(self.text_numbers[tens]) + int(self.text_numbers[ones])
+        if parts and parts[-1] in self.text_numbers:
+            return int(self.text_numbers[parts[-1]])
         return None
 
     def _extract_timer_args(self, text: str) -> Dict[str, Any]:
@@ -333,9 +362,12 @@ class OptimizedToolParser:
             match = re.search(r'(\d+)\s*час', text)
             if match:
                 args["hours"] = int(match.group(1))
-        # По умолчанию 1 минута
+        # Единица без числа: "на полчаса", "на час"
         if not args:
-            args["minutes"] = 1
+            if re.search(r'\bполчаса\b', text, re.IGNORECASE):
+                args["minutes"] = 30
+            elif re.search(r'\bчас\b', text, re.IGNORECASE):
+                args["hours"] = 1
         return args
 
     def _extract_notification_args(self, text: str) -> Dict[str, Any]:
@@ -412,7 +444,7 @@ class OptimizedToolParser:
         # Извлекаем текст напоминания - убираем команду и время
         text_clean = text
         text_clean = re.sub(r'^(?:поставь\s+)?напомни(е)?\s*(?:мне\s+)?', '', text_clean, flags=re.IGNORECASE)
-        text_clean = re.sub(r'через\s+(?:\d+|[а-яА-Я\s]+)\s*(?:секунд|сек|минут|мин|час|часов)', '', text_clean, flags=re.IGNORECASE)
+        text_clean = re.sub(r'через\s+(?:\d+|[а-яА-Я\s]+)\s*(?:секунд|сек|минут|мин|час)\w*', '', text_clean, flags=re.IGNORECASE)
         text_clean = re.sub(r'\s+', ' ', text_clean).strip()
         if not text_clean:
             text_clean = "Напоминание"
@@ -434,12 +466,12 @@ class OptimizedToolParser:
             if match:
                 contact = match.group(1).strip()
                 # Убираем лишние слова
-                contact = re.sub(r'\b(?:номер|телефон)\b', '', contact).strip()
-                args["contact_name"] = contact
+                contact = re.sub(r'\b(?:номер|телефон)\b', '', contact)
+                # Время звонка и обращение к себе контактом не являются: "позвони мне через пять минут"
+                contact = re.sub(r'\bчерез\b.*$', '', contact).strip()
+                if contact and contact not in self.self_pronouns:
+                    args["contact_name"] = contact
                 break
-                
-        if not args.get("contact_name"):
-            args["contact_name"] = "неизвестный контакт"
             
         return args
 
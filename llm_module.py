@@ -1,5 +1,6 @@
 import os
-from typing import Optional, List, Dict, Any
+import logging
+from typing import Optional, List, Dict, Any, AsyncIterator
 from dotenv import load_dotenv
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_core.language_models import BaseChatModel
@@ -20,7 +21,7 @@ LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.3"))
 LOCAL_MAX_TOKENS = int(os.getenv("LOCAL_MAX_TOKENS", "64"))    # Уменьшен для скорости
 LOCAL_CONTEXT    = int(os.getenv("LOCAL_CONTEXT",    "256"))   # Уменьшен контекст
 LOCAL_THREADS    = int(os.getenv("LOCAL_THREADS",    "8"))      # Используем все 8 ядер
-LOCAL_KEEP_ALIVE = int(os.getenv("LOCAL_KEEP_ALIVE", "60"))    # 1 минута в памяти
+LOCAL_KEEP_ALIVE = int(os.getenv("LOCAL_KEEP_ALIVE", "-1"))    # -1: модель и KV-кэш префикса всегда в памяти
 LOCAL_TOP_P      = float(os.getenv("LOCAL_TOP_P",   "0.9"))    # top_p
 LOCAL_TOP_K      = int(os.getenv("LOCAL_TOP_K",       "20"))   # Уменьшен для скорости
 # Настройки квантизации для Ollama
@@ -29,6 +30,9 @@ LOCAL_LOW_VRAM   = os.getenv("LOCAL_LOW_VRAM", "true").lower() == "true"
 
 SHOW_TEXT = os.getenv("SHOW_TEXT", "true").lower() == "true"
 
+# Дочерний логгер агента: вывод настраивается в agent.py
+log = logging.getLogger("agent.llm")
+
 # --- PROVIDER INITIALIZATION ---
 def _init_llm(provider: str, temperature: float) -> BaseChatModel:
     provider = provider.lower()
@@ -83,6 +87,12 @@ class LLMManager:
         self.provider = provider.lower()
         self.temperature = temperature
         self.llm = _init_llm(self.provider, self.temperature)
+        self.provider_info = self._build_provider_info()
+        # Последняя привязка инструментов: список tools постоянный, bind_tools не повторяем
+        self._bound_tools = None
+        self._llm_with_tools = None
+        # Системные сообщения по тексту промпта: промптов два-три, собираем каждое один раз
+        self._system_messages: Dict[str, SystemMessage] = {}
         
         # Предзагрузка модели для Orange Pi
         if self.provider == "local":
@@ -105,6 +115,31 @@ class LLMManager:
         except Exception as e:
             print(f"[WARNING] Не удалось предзагрузить модель: {e}")
 
+    def build_messages(self, prompt: str, system_prompt: Optional[str] = None) -> list:
+        """
+        Собирает сообщения для модели. Системный промпт передается побайтно одинаковым,
+        чтобы провайдер мог переиспользовать кэш префикса.
+        """
+        if not system_prompt:
+            return [HumanMessage(content=prompt)]
+        return [self._system_message(system_prompt), HumanMessage(content=prompt)]
+
+    def _system_message(self, system_prompt: str) -> SystemMessage:
+        message = self._system_messages.get(system_prompt)
+        if message is None:
+            if self.provider == "claude":
+                # Явное кэширование промпта Anthropic
+                message = SystemMessage(content=[{
+                    "type": "text",
+                    "text": system_prompt,
+                    "cache_control": {"type": "ephemeral"},
+                }])
+            else:
+                # Ollama/llama.cpp кэшируют одинаковый префикс автоматически
+                message = SystemMessage(content=system_prompt)
+            self._system_messages[system_prompt] = message
+        return message
+
     async def generate_response(self, prompt: str, system_prompt: Optional[str] = None, tools: Optional[List[Dict[str, Any]]] = None) -> str:
         """
         Генерирует ответ для заданного запроса.
@@ -114,13 +149,10 @@ class LLMManager:
             system_prompt: Опциональный системный промпт
             tools: Опциональный список инструментов для LLM
         """
-        messages = []
-        if system_prompt:
-            messages.append(SystemMessage(content=system_prompt))
-        messages.append(HumanMessage(content=prompt))
+        messages = self.build_messages(prompt, system_prompt)
         
         try:
-            print(f"[LOG] [LLM] Отправка запроса модели: {prompt[:50]}...")
+            log.debug("[LLM] Отправка запроса модели: %.50s...", prompt)
             
             # Используем инструменты, если они предоставлены
             if tools:
@@ -130,24 +162,52 @@ class LLMManager:
                     # Fallback - обрабатываем без tools
                     response = await self.llm.ainvoke(messages)
                 else:
-                    model_with_tools = self.llm.bind_tools(tools)
-                    response = await model_with_tools.ainvoke(messages)
+                    response = await self.bind_tools(tools).ainvoke(messages)
             else:
                 response = await self.llm.ainvoke(messages)
                 
-            print(f"[LOG] [LLM] Получен ответ модели: {str(response)[:100]}...")
+            log.debug("[LLM] Получен ответ модели: %.100s...", response)
             
             # Извлекаем текст ответа из различных форматов
             if hasattr(response, "content"):
                 return response.content if isinstance(response.content, str) else str(response.content)
             return str(response)
         except Exception as e:
-            print(f"[ERROR] LLM generation error: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("[LLM] Ошибка генерации: %s", e)
             return f"Произошла ошибка при генерации ответа: {str(e)}"
 
+    def bind_tools(self, tools: List[Dict[str, Any]]):
+        """Возвращает модель с привязанными инструментами, переиспользуя привязку для того же списка"""
+        if tools is not self._bound_tools:
+            self._llm_with_tools = self.llm.bind_tools(tools)
+            self._bound_tools = tools
+        return self._llm_with_tools
+
+    async def stream_response(self, prompt: str, system_prompt: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Потоково генерирует ответ, отдавая текст по мере поступления токенов.
+        
+        Args:
+            prompt: Запрос пользователя
+            system_prompt: Опциональный системный промпт
+        """
+        messages = self.build_messages(prompt, system_prompt)
+        
+        async for chunk in self.llm.astream(messages):
+            content = chunk.content  # astream чат-модели отдает AIMessageChunk
+            if isinstance(content, str):
+                if content:
+                    yield content
+                continue
+            # Anthropic стримит список блоков: текст берем из блоков type=text
+            for block in content:
+                if isinstance(block, dict) and block.get("type") == "text" and block.get("text"):
+                    yield block["text"]
+
     def get_provider_info(self) -> dict:
+        return self.provider_info
+
+    def _build_provider_info(self) -> dict:
         if self.provider == "claude":
             model = LLM_MODEL or CLAUDE_MODEL
             return {"provider": "Anthropic Claude", "model": model}
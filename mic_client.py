@@ -23,6 +23,12 @@ FRAME_SIZE = int(SAMPLE_RATE * (FRAME_DURATION_MS / 1000))
 SILENCE_THRESHOLD_FRAMES = int(1000 / FRAME_DURATION_MS)  # ~1 секунда тишины
 SPEECH_START_THRESHOLD = 3
 WAKEWORD = os.getenv("WAKEWORD", "okey")
+# Аудио-ответ приходит одним сообщением, лимит должен вмещать самый длинный ответ
+MAX_RESPONSE_SIZE = int(os.getenv("MAX_RESPONSE_SIZE", 64*2**20))
+# Потоковый ответ: сервер присылает WAV по предложениям между BEGIN и END
+AUDIO_STREAM_HELLO = "STREAM_AUDIO"
+AUDIO_STREAM_BEGIN = "AUDIO_STREAM_BEGIN"
+AUDIO_STREAM_END = "AUDIO_STREAM_END"
 
 # Enable or disable wake word detection
 USE_WAKE_WORD = os.getenv("USE_WAKE_WORD", "true").lower() in ("true", "1", "yes")
@@ -92,9 +98,12 @@ async def vad_record_and_send(device=None):
     while True:
         try:
             print(f"[INFO] Connecting to {URI} (микрофон)")
-            async with websockets.connect(URI, max_size=8*2**20, 
+            async with websockets.connect(URI, max_size=MAX_RESPONSE_SIZE, 
+                                         compression=None,  # аудио не сжимается deflate
                                          ping_interval=300, # 5 минут между пингами
                                          ping_timeout=None) as ws:  # отключаем таймаут
+                # Просим присылать ответ по предложениям: первое играет, пока синтезируются следующие
+                await ws.send(AUDIO_STREAM_HELLO)
                 await mic_stream_loop(ws, device)
         except Exception as e:
             print(f"[ERROR] Ошибка соединения: {e} (микрофон)")
@@ -107,7 +116,7 @@ async def mic_stream_loop(ws, device=None):
     in_speech = False
     speech_frames = 0
     silence_frames = 0
-    audio_buffer = []
+    audio_buffer = bytearray()  # кадры дописываются в один буфер, склейка перед отправкой не нужна
     processing_speech = False
     waiting_for_wake_word = USE_WAKE_WORD  # Start in wake word mode if enabled
     
@@ -177,7 +186,7 @@ async def mic_stream_loop(ws, device=None):
             if not in_speech:
                 if is_speech_frame:
                     speech_frames += 1
-                    audio_buffer.append(data)
+                    audio_buffer += data
                     if speech_frames >= SPEECH_START_THRESHOLD:
                         in_speech = True
                         silence_frames = 0
@@ -187,17 +196,17 @@ async def mic_stream_loop(ws, device=None):
                     audio_buffer.clear()
             else:
                 if is_speech_frame:
-                    audio_buffer.append(data)
+                    audio_buffer += data
                     silence_frames = 0
                 else:
                     silence_frames += 1
                     if silence_frames < SILENCE_THRESHOLD_FRAMES:
-                        audio_buffer.append(data)
+                        audio_buffer += data
                     else:
                         in_speech = False
                         print("[VAD] Конец речи, отправка... (микрофон)")
-                        combined_data = b"".join(audio_buffer)
-                        audio_buffer.clear()
+                        # Буфер уходит на отправку целиком, для новой фразы заводим новый
+                        combined_data, audio_buffer = audio_buffer, bytearray()
                         speech_frames = 0
                         silence_frames = 0
                         
@@ -222,32 +231,13 @@ async def process_and_send(ws, combined_data):
         # Добавляем большой таймаут для операций recv
         response = await asyncio.wait_for(ws.recv(), timeout=3600)  # 1 час таймаут
         
-        # Проверяем, начинается ли передача фрагментированного аудио
-        if response == "AUDIO_CHUNKS_BEGIN":
-            print("[INFO] Получаем фрагментированное аудио...")
-            audio_chunks = []
-            
-            # Собираем все фрагменты аудио
-            while True:
-                chunk = await ws.recv()
-                if isinstance(chunk, str) and chunk == "AUDIO_CHUNKS_END":
-                    break
-                if isinstance(chunk, bytes):
-                    audio_chunks.append(chunk)
-                    print(f"[INFO] Получен фрагмент аудио: {len(chunk)} байт")
-            
-            # Объединяем все фрагменты в одно аудио
-            if audio_chunks:
-                combined_audio = b"".join(audio_chunks)
-                print(f"[INFO] Собрано аудио из {len(audio_chunks)} фрагментов, общий размер: {len(combined_audio)} байт")
-                threading.Thread(target=play_audio, args=(combined_audio,)).start()
-            else:
-                print("[WARNING] Получены пустые фрагменты аудио")
-        
-        # Обычный ответ (не разбитый на части)
-        elif isinstance(response, bytes):
+        # Большие ответы приходят фрагментированным WebSocket-сообщением,
+        # библиотека собирает его, и recv() возвращает аудио целиком
+        if isinstance(response, bytes):
             print(f"[INFO] Получен аудио-ответ: {len(response)} байт")
             threading.Thread(target=play_audio, args=(response,)).start()
+        elif response == AUDIO_STREAM_BEGIN:
+            await receive_audio_stream(ws)
         else:
             print(f"[INFO] Получен текстовый ответ: {response}")
     except asyncio.TimeoutError:
@@ -256,6 +246,29 @@ async def process_and_send(ws, combined_data):
     except Exception as e:
         print(f"[ERROR] Ошибка при отправке/получении: {e}")
 
+def play_audio_queue(chunks: queue.Queue):
+    """Проигрывает фрагменты ответа по порядку, пока не придет None"""
+    while (chunk := chunks.get()) is not None:
+        play_audio(chunk)
+
+async def receive_audio_stream(ws):
+    """Принимает ответ по предложениям и проигрывает каждое сразу после получения"""
+    chunks = queue.Queue()
+    threading.Thread(target=play_audio_queue, args=(chunks,), daemon=True).start()
+    try:
+        while True:
+            message = await asyncio.wait_for(ws.recv(), timeout=3600)
+            if isinstance(message, bytes):
+                print(f"[INFO] Получен фрагмент ответа: {len(message)} байт")
+                chunks.put(message)
+            elif message == AUDIO_STREAM_END:
+                break
+            else:
+                print(f"[INFO] Получен текстовый ответ: {message}")
+                break
+    finally:
+        chunks.put(None)
+
 def run_wake_detector():
     """Run the wake word detector in a separate thread"""
     global wake_detector
@@ -1,5 +1,6 @@
 # optimized_mqtt_tools.py
-import json
+import logging
+import orjson
 import time
 import asyncio
 import paho.mqtt.client as mqtt
@@ -20,6 +21,9 @@ TTS_SAY_PATH = os.getenv("TTS_SAY_PATH", "hermes/tts/say")
 MQTT_TIMEOUT = int(os.getenv("MQTT_TIMEOUT", "3"))  # Уменьшен с 10 до 3 секунд
 MQTT_ENABLED = os.getenv("MQTT_ENABLED", "true").lower() == "true"
 
+# Дочерний логгер агента: вывод настраивается в agent.py
+log = logging.getLogger("agent.mqtt")
+
 # Глобальные переменные
 client = None
 response_queue = {}
@@ -44,7 +48,7 @@ class MQTTManager:
     
     def _try_connect(self):
         if self.connection_attempts >= self.max_attempts:
-            print(f"[MQTT] Превышено максимальное количество попыток подключения ({self.max_attempts})")
+            log.warning("[MQTT] Превышено максимальное количество попыток подключения (%d)", self.max_attempts)
             return
             
         try:
@@ -58,18 +62,18 @@ class MQTTManager:
             self.connection_attempts += 1
             
         except Exception as e:
-            print(f"[MQTT] Ошибка подключения: {e}")
+            log.error("[MQTT] Ошибка подключения: %s", e)
             self.connected = False
             self.connection_attempts += 1
     
     def _on_connect(self, client, userdata, flags, reason_code, properties):
         if reason_code == 0:
-            print("[MQTT] Подключение успешно")
+            log.info("[MQTT] Подключение успешно")
             self.connected = True
             self.connection_attempts = 0  # Сбрасываем счетчик при успешном подключении
             client.subscribe(f"{RECOGNIZED_INTENT_PATH}/response/#")
         else:
-            print(f"[MQTT] Ошибка подключения: {reason_code}")
+            log.error("[MQTT] Ошибка подключения: %s", reason_code)
             self.connected = False
     
     def _on_message(self, client, userdata, msg):
@@ -86,10 +90,10 @@ class MQTTManager:
                     response_queue[request_id] = payload
                     
         except Exception as e:
-            print(f"[MQTT] Ошибка обработки сообщения: {e}")
+            log.error("[MQTT] Ошибка обработки сообщения: %s", e)
     
     def _on_disconnect(self, client, userdata, flags, reason_code, properties):
-        print(f"[MQTT] Отключение: {reason_code}")
+        log.warning("[MQTT] Отключение: %s", reason_code)
         self.connected = False
 
 # Глобальный экземпляр менеджера
@@ -131,10 +135,10 @@ def publish_mqtt_request(intent_name: str, slots: List[Dict] = None, raw_input:
         payload["rawInput"] = raw_input
     
     try:
-        client.publish(RECOGNIZED_INTENT_PATH, json.dumps(payload))
+        client.publish(RECOGNIZED_INTENT_PATH, orjson.dumps(payload))
         return request_id
     except Exception as e:
-        print(f"[MQTT] Ошибка отправки: {e}")
+        log.error("[MQTT] Ошибка отправки: %s", e)
         if request_id in response_queue:
             del response_queue[request_id]
         return None
@@ -157,7 +161,7 @@ async def tool_get_time_async():
     response = await wait_for_response_async(request_id)
     if response:
         try:
-            data = json.loads(response)
+            data = orjson.loads(response)
             return data.get("text", "Не удалось получить время")
         except:
             return response
@@ -172,7 +176,7 @@ def tool_get_time():
         # Запускаем асинхронную версию в новом event loop
         return asyncio.run(tool_get_time_async())
     except Exception as e:
-        print(f"[ERROR] tool_get_time: {e}")
+        log.error("tool_get_time: %s", e)
         # Fallback
         now = datetime.now()
         return f"Текущее время {now.hour} часов, {now.minute} минут"
@@ -206,7 +210,7 @@ async def tool_set_timer_async(minutes: int = 0, seconds: int = 0, hours: int =
     response = await wait_for_response_async(request_id)
     if response:
         try:
-            data = json.loads(response)
+            data = orjson.loads(response)
             return data.get("text", "Таймер установлен")
         except:
             return response
@@ -218,7 +222,7 @@ def tool_set_timer(minutes: int = 0, seconds: int = 0, hours: int = 0):
     try:
         return asyncio.run(tool_set_timer_async(minutes, seconds, hours))
     except Exception as e:
-        print(f"[ERROR] tool_set_timer: {e}")
+        log.error("tool_set_timer: %s", e)
         return f"Ошибка при установке таймера: {str(e)}"
 
 async def tool_set_notification_async(text: str, minutes: int = 0, seconds: int = 0, hours: int = 0):
@@ -255,7 +259,7 @@ async def tool_set_notification_async(text: str, minutes: int = 0, seconds: int
     response = await wait_for_response_async(request_id)
     if response:
         try:
-            data = json.loads(response)
+            data = orjson.loads(response)
             return data.get("text", "Напоминание установлено")
         except:
             return response
@@ -267,7 +271,7 @@ def tool_set_notification(text: str, minutes: int = 0, seconds: int = 0, hours:
     try:
         return asyncio.run(tool_set_notification_async(text, minutes, seconds, hours))
     except Exception as e:
-        print(f"[ERROR] tool_set_notification: {e}")
+        log.error("tool_set_notification: %s", e)
         return f"Ошибка при установке напоминания: {str(e)}"
 
 async def tool_get_weather_async():
@@ -282,7 +286,7 @@ async def tool_get_weather_async():
     response = await wait_for_response_async(request_id)
     if response:
         try:
-            data = json.loads(response)
+            data = orjson.loads(response)
             return data.get("text", "Не удалось получить информацию о погоде")
         except:
             return response
@@ -294,7 +298,7 @@ def tool_get_weather():
     try:
         return asyncio.run(tool_get_weather_async())
     except Exception as e:
-        print(f"[ERROR] tool_get_weather: {e}")
+        log.error("tool_get_weather: %s", e)
         return f"Ошибка при получении погоды: {str(e)}"
 
 async def tool_call_contact_async(contact_name: str):
@@ -311,7 +315,7 @@ async def tool_call_contact_async(contact_name: str):
     response = await wait_for_response_async(request_id)
     if response:
         try:
-            data = json.loads(response)
+            data = orjson.loads(response)
             return data.get("text", f"Звоню контакту {contact_name}")
         except:
             return response
@@ -323,7 +327,7 @@ def tool_call_contact(contact_name: str):
     try:
         return asyncio.run(tool_call_contact_async(contact_name))
     except Exception as e:
-        print(f"[ERROR] tool_call_contact: {e}")
+        log.error("tool_call_contact: %s", e)
         return f"Ошибка при звонке контакту: {str(e)}"
 
 # Определение инструментов для LangGraph (без изменений)
@@ -402,32 +406,33 @@ tool_mapping = {
     "call_contact": tool_call_contact
 }
 
+# Дружелюбные сообщения об ошибке инструмента
+tool_error_messages = {
+    "get_time": "Не удалось получить текущее время",
+    "set_timer": "Не удалось установить таймер",
+    "set_notification": "Не удалось создать напоминание",
+    "get_weather": "Не удалось получить информацию о погоде",
+    "call_contact": "Не удалось совершить звонок"
+}
+
 def execute_tool(tool_name: str, tool_args: Dict[str, Any]) -> str:
     """Выполняет инструмент по имени с указанными аргументами"""
-    if tool_name in tool_mapping:
-        try:
-            return tool_mapping[tool_name](**tool_args)
-        except Exception as e:
-            print(f"[ERROR] execute_tool({tool_name}): {e}")
-            # Возвращаем более дружелюбное сообщение об ошибке
-            error_messages = {
-                "get_time": "Не удалось получить текущее время",
-                "set_timer": "Не удалось установить таймер",
-                "set_notification": "Не удалось создать напоминание",
-                "get_weather": "Не удалось получить информацию о погоде",
-                "call_contact": "Не удалось совершить звонок"
-            }
-            return error_messages.get(tool_name, f"Ошибка при выполнении команды")
-    else:
+    func = tool_mapping.get(tool_name)
+    if func is None:
         return "Команда не найдена"
+    try:
+        return func(**tool_args)
+    except Exception as e:
+        log.error("execute_tool(%s): %s", tool_name, e)
+        return tool_error_messages.get(tool_name, "Ошибка при выполнении команды")
 
 def init_mqtt():
     """Инициализация MQTT (опционально)"""
     if MQTT_ENABLED:
         mqtt_manager.get_client()
-        print(f"[MQTT] Инициализация завершена. Статус: {'подключен' if mqtt_manager.connected else 'отключен'}")
+        log.info("[MQTT] Инициализация завершена. Статус: %s", "подключен" if mqtt_manager.connected else "отключен")
     else:
-        print("[MQTT] MQTT отключен в настройках")
+        log.info("[MQTT] MQTT отключен в настройках")
 
 def get_mqtt_status() -> Dict[str, Any]:
     """Возвращает статус MQTT подключения"""
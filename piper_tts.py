@@ -1,4 +1,5 @@
 import asyncio
+import logging
 import os
 import platform
 import subprocess
@@ -9,6 +10,10 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Команда запуска piper печатается только при LOG_LEVEL=DEBUG
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="[%(levelname)s] %(message)s")
+log = logging.getLogger(__name__)
+
 # === КОНФИГУРАЦИЯ ===
 # Путь к .onnx-модели и конфигу
 PIPER_MODEL_PATH = os.getenv("PIPER_MODEL_PATH", "./models/ru_RU-denis-medium/ru_RU-denis-medium.onnx")
@@ -65,7 +70,7 @@ async def tts_piper(text: str, model_path: str = None, speaker_id: int = None) -
         if speaker_id > 0:
             cmd.extend(['--speaker', str(speaker_id)])
             
-        print(f"[DEBUG] Запускаю: {' '.join(cmd)}")
+        log.debug("Запускаю: %s", cmd)
         
         if platform.system() == "Windows":
             # Windows: запись текста во временный файл и редирект через тип
@@ -140,6 +145,7 @@ async def main_ws():
         TTS_WS_HOST, 
         TTS_WS_PORT, 
         max_size=8*2**20, 
+        compression=None,    # аудио не сжимается deflate
         ping_interval=300,   # 5 минут
         ping_timeout=None):  # Без таймаута
         await asyncio.Future()  # run forever
@@ -158,6 +164,12 @@ async def test_tts():
 # === Точка входа ===
 if __name__ == "__main__":
     import sys
+    # uvloop, если установлен
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     if len(sys.argv) > 1 and sys.argv[1] == "ws":
         asyncio.run(main_ws())
     else:
@@ -0,0 +1,126 @@
+# semantic_cache.py
+import asyncio
+import logging
+import re
+import threading
+import time
+from typing import Any, Optional
+
+import numpy as np
+from cachetools import LRUCache
+
+log = logging.getLogger("agent.semantic_cache")
+
+# Указательные слова и местоимения: смысл такой фразы зависит от предыдущей реплики,
+# а короткие "выключи его" / "включи его" почти совпадают по эмбеддингу
+_CONTEXTUAL_RE = re.compile(
+    r"\b(?:это|этот|эта|эти|этого|этой|тот|та|те|то|его|е[её]|их|ему|ей|им|он|она|оно|они|"
+    r"там|тут|туда|сюда|тогда|тоже|также|е[щш][её]|снова|опять|так)\b",
+    re.IGNORECASE,
+)
+
+def is_contextual(text: str) -> bool:
+    """Фраза ссылается на предыдущий контекст разговора"""
+    return _CONTEXTUAL_RE.search(text) is not None
+
+class SemanticCache:
+    """Кэш ответов по смыслу запроса: похожие по эмбеддингу фразы получают готовый ответ"""
+
+    def __init__(self, model_name: str, threshold: float = 0.92, maxsize: int = 64, ttl: Optional[float] = None):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.model = None
+        self._load_lock = threading.Lock()
+        # Матрица нормализованных эмбеддингов, создается при первом добавлении
+        self.vectors: Optional[np.ndarray] = None
+        self.values: list = [None] * maxsize
+        # Пространство имен записи (например, системный промпт): разные промпты не смешиваются
+        self.namespaces = np.zeros(maxsize, dtype=np.int64)
+        # Время последнего обращения для вытеснения LRU
+        self.last_used = np.zeros(maxsize, dtype=np.int64)
+        # Срок жизни записи (time.monotonic), как у TTLCache точного кэша
+        self.expires = np.full(maxsize, np.inf)
+        self.tick = 0
+        self.size = 0
+        # Эмбеддинги последних фраз: одну фразу ищут в двух пространствах имен и потом сохраняют,
+        # модель считает ее один раз, повторные обращения обходятся без перехода в поток
+        self._embeddings = LRUCache(maxsize=32)
+
+    def load(self):
+        """Загружает модель эмбеддингов (однократно, потокобезопасно)"""
+        with self._load_lock:
+            if self.model is None:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                except ImportError:
+                    raise ImportError("[ERROR] sentence-transformers not installed. Run: pip install sentence-transformers")
+                self.model = SentenceTransformer(self.model_name)
+                log.info("[CACHE] Модель эмбеддингов загружена: %s", self.model_name)
+        return self.model
+
+    def _encode(self, text: str) -> np.ndarray:
+        model = self.model or self.load()
+        emb = model.encode(text, normalize_embeddings=True).astype(np.float32)
+        emb.setflags(write=False)
+        return emb
+
+    async def _embed(self, text: str) -> np.ndarray:
+        emb = self._embeddings.get(text)
+        if emb is None:
+            # Модель считает в отдельном потоке, чтобы не блокировать event loop
+            emb = await asyncio.to_thread(self._encode, text)
+            self._embeddings[text] = emb
+        return emb
+
+    async def lookup(self, text: str, namespace: Optional[str] = None) -> Optional[Any]:
+        """Возвращает сохраненный ответ на близкую по смыслу фразу или None"""
+        # Контекстные фразы отвечаются только по точному совпадению, не по похожести
+        if is_contextual(text):
+            return None
+        emb = await self._embed(text)
+        if not self.size:
+            return None
+        best, sim = self._nearest(emb, namespace)
+        if sim < self.threshold:
+            return None
+        self.tick += 1
+        self.last_used[best] = self.tick
+        log.debug("[CACHE] Семантическое попадание %.3f для: '%s'", sim, text)
+        return self.values[best]
+
+    def _nearest(self, emb: np.ndarray, namespace: Optional[str], alive: bool = True):
+        """Ближайшая запись того же пространства имен: (слот, косинус). alive: без просроченных"""
+        sims = self.vectors[:self.size] @ emb  # векторы нормализованы: скалярное произведение = косинус
+        sims[self.namespaces[:self.size] != hash(namespace)] = -1.0
+        if alive:
+            sims[self.expires[:self.size] <= time.monotonic()] = -1.0
+        best = int(sims.argmax())
+        return best, float(sims[best])
+
+    def _free_slot(self, now: float) -> int:
+        if self.size < self.maxsize:
+            self.size += 1
+            return self.size - 1
+        # Сначала занимаем просроченные записи, затем ту, к которой дольше всего не обращались
+        expired = np.flatnonzero(self.expires <= now)
+        return int(expired[0]) if expired.size else int(self.last_used.argmin())
+
+    async def add(self, text: str, value: Any, namespace: Optional[str] = None):
+        if is_contextual(text):
+            return
+        emb = await self._embed(text)
+        if self.vectors is None:
+            self.vectors = np.zeros((self.maxsize, emb.shape[0]), dtype=np.float32)
+        now = time.monotonic()
+        # Та же по смыслу фраза (в том числе просроченная) обновляется, а не занимает второй слот
+        slot, sim = self._nearest(emb, namespace, alive=False) if self.size else (0, -1.0)
+        if sim < self.threshold:
+            slot = self._free_slot(now)
+        self.tick += 1
+        self.vectors[slot] = emb
+        self.values[slot] = value
+        self.namespaces[slot] = hash(namespace)
+        self.last_used[slot] = self.tick
+        self.expires[slot] = now + self.ttl if self.ttl else np.inf
@@ -0,0 +1,264 @@
+import asyncio
+import pytest
+import websockets
+
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agent
+from agent import SentenceSplitter, extract_tts_text, PersistentWS, WSPool
+
+
+def split(tokens):
+
+    splitter = SentenceSplitter()
+    sentences = []
+    for token in tokens:
+        sentences += splitter.feed(token)
+    return sentences, splitter.flush()
+
+
+def test_splitter_emits_finished_sentences():
+
+    sentences, rest = split(["Привет", "! Как", " дела? Хорошо"])
+
+    assert sentences == ["Привет!", "Как дела?"]
+    assert rest == ["Хорошо"]
+
+
+def test_splitter_skips_think_block_split_across_tokens():
+
+    sentences, rest = split(["Да. <th", "ink>секрет. ещё</th", "ink>Готово", " всё."])
+
+    assert sentences + rest == ["Да.", "Готово всё."]
+
+
+def test_splitter_drops_unclosed_think_block():
+
+    sentences, rest = split(["Ответ. <think>рассуждение без конца"])
+
+    assert sentences + rest == ["Ответ."]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("  Привет  ", "Привет"),
+    ("<think>план</think> Ответ ", "Ответ"),
+    ("<THINK>план</THINK>Ответ", "Ответ"),
+    ('{"text": "из json"}', "из json"),
+    ('{"content": "контент"}', "контент"),
+    ('[{"text": "а"}, {"type": "tool_use"}, {"text": "б"}]', "а б"),
+    ('[{"text": 5}]', "5"),
+    ("[не json", "[не json"),
+])
+def test_extract_tts_text(text, expected):
+
+    assert extract_tts_text(text) == expected
+
+
+async def reply_server(handler_delay=0.05):
+
+    async def handler(ws):
+        try:
+            async for message in ws:
+                await asyncio.sleep(handler_delay)
+                await ws.send("reply:" + message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    return await websockets.serve(handler, "127.0.0.1", 0)
+
+
+def server_url(server):
+
+    port = next(iter(server.sockets)).getsockname()[1]
+    return f"ws://127.0.0.1:{port}"
+
+
+async def cancel_mid_request(client, payload):
+
+    task = asyncio.create_task(client.request(payload))
+    await asyncio.sleep(0.02)  # запрос отправлен, ответ еще не пришел
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+def test_cancelled_request_does_not_leak_reply():
+
+    async def scenario():
+        server = await reply_server()
+        try:
+            client = PersistentWS(server_url(server))
+            await cancel_mid_request(client, "A")
+            assert await client.request("B") == "reply:B"
+            assert await client.request("C") == "reply:C"
+            await client.close()
+        finally:
+            server.close()
+
+    asyncio.run(scenario())
+
+
+def test_pool_resets_connection_after_cancel():
+
+    async def scenario():
+        server = await reply_server()
+        try:
+            pool = WSPool(server_url(server), 1)
+            await cancel_mid_request(pool, "A")
+            assert await pool.request("B") == "reply:B"
+        finally:
+            server.close()
+
+    asyncio.run(scenario())
+
+
+def test_pool_request_uses_connection_warmed_by_ensure():
+
+    async def scenario():
+        server = await reply_server(handler_delay=0)
+        try:
+            pool = WSPool(server_url(server), 2)
+            await pool.ensure()
+            assert await pool.request("A") == "reply:A"
+            conns = [pool.idle.get_nowait() for _ in range(2)]
+            # второе соединение так и не понадобилось
+            assert sum(conn.ws is not None for conn in conns) == 1
+        finally:
+            server.close()
+
+    asyncio.run(scenario())
+
+
+def make_stream(tokens, error=None):
+
+    async def stream_response(prompt, system_prompt=None):
+        for token in tokens:
+            await asyncio.sleep(0)
+            yield token
+        if error:
+            raise error
+
+    return stream_response
+
+
+class SlowTTS:
+    """tts_client, который синтезирует до отмены и запоминает запущенные задачи"""
+
+    def __init__(self, delay=10):
+        self.delay = delay
+        self.tasks = []
+
+    async def __call__(self, text):
+        self.tasks.append(asyncio.current_task())
+        await asyncio.sleep(self.delay)
+        return b""
+
+
+class ClosedSink:
+
+    started = False
+
+    async def send(self, wav):
+        raise ConnectionError("client went away")
+
+
+def test_stream_llm_error_cancels_tts(monkeypatch):
+
+    tts = SlowTTS()
+    monkeypatch.setattr(agent.llm_manager, "stream_response", make_stream(["Раз. ", "Два. "], RuntimeError("llm")))
+    monkeypatch.setattr(agent, "tts_client", tts)
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await agent.stream_llm_to_tts("привет", "system")
+        assert tts.tasks and all(task.cancelled() for task in tts.tasks)
+
+    asyncio.run(scenario())
+
+
+def test_stream_cancel_cancels_tts_and_sender(monkeypatch):
+
+    tts = SlowTTS()
+    monkeypatch.setattr(agent.llm_manager, "stream_response", make_stream(["Раз. ", "Два. "]))
+    monkeypatch.setattr(agent, "tts_client", tts)
+
+    async def scenario():
+        task = asyncio.create_task(agent.stream_llm_to_tts("привет", "system", ClosedSink()))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert len(asyncio.all_tasks()) == 1
+
+    asyncio.run(scenario())
+
+
+def test_stream_sink_failure_is_not_llm_error(monkeypatch):
+
+    monkeypatch.setattr(agent.llm_manager, "stream_response", make_stream(["Раз. ", "Два."]))
+    monkeypatch.setattr(agent, "tts_client", SlowTTS(delay=0))
+
+    async def scenario():
+        content, _ = await agent.stream_llm_to_tts("привет", "system", ClosedSink())
+        assert content == "Раз. Два."
+        assert len(asyncio.all_tasks()) == 1
+
+    asyncio.run(scenario())
+
+
+def tiny_wav():
+
+    import io
+    import wave
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(48000)
+        w.writeframes(b"\x00\x00" * 10)
+    return buf.getvalue()
+
+
+class RecordingTTS:
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, text, conn=None):
+        self.calls.append((text, conn))
+        return tiny_wav()
+
+
+def test_prewarm_uses_own_connection_and_skips_numbers(monkeypatch):
+
+    tts = RecordingTTS()
+    monkeypatch.setattr(agent, "tts_client", tts)
+    monkeypatch.setattr(agent, "tts_fragment_cache", {})
+
+    asyncio.run(agent.prewarm_tts_fragments())
+
+    assert tts.calls
+    assert all(conn is agent.tts_prewarm_ws for _, conn in tts.calls)
+    assert not any(text.isdigit() for text, _ in tts.calls)
+
+
+def test_template_numbers_are_synthesized_lazily(monkeypatch):
+
+    tts = RecordingTTS()
+    monkeypatch.setattr(agent, "tts_client", tts)
+    monkeypatch.setattr(agent, "tts_fragment_cache", {})
+
+    async def scenario():
+        await agent.prewarm_tts_fragments()
+        text = "Текущее время 12 часов, 5 минут"
+        assert agent.fragment_tts(text) is None
+        agent.fragment_tts(text)  # повторный промах не запускает синтез второй раз
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(t for t in agent.background_tasks if t.get_loop() is loop))
+        assert agent.fragment_tts(text) is not None
+        assert [t for t, _ in tts.calls].count("12") == 1
+
+    asyncio.run(scenario())
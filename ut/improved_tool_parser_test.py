@@ -0,0 +1,106 @@
+import pytest
+
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from improved_tool_parser import OptimizedToolParser
+
+
+@pytest.fixture
+def parser():
+
+    return OptimizedToolParser()
+
+
+def parse(parser, text):
+
+    return parser.parse_text_for_tools(text, use_llm_fallback=False)
+
+
+@pytest.mark.parametrize("text, args", [
+    ("поставь таймер на 5 минут", {"minutes": 5}),
+    ("поставь таймер на пять минут", {"minutes": 5}),
+    ("установи таймер на двадцать пять минут", {"minutes": 25}),
+    ("засеки десять минут", {"minutes": 10}),
+    ("таймер на 30 секунд", {"seconds": 30}),
+    ("поставь таймер на час", {"hours": 1}),
+    ("поставь таймер на два часа", {"hours": 2}),
+    ("таймер на полчаса", {"minutes": 30}),
+])
+def test_timer_commands(parser, text, args):
+
+    result = parse(parser, text)
+
+    assert result[0].name == "set_timer"
+    assert result[0].args == args
+
+
+@pytest.mark.parametrize("text", [
+    "я буду дома через пять минут",
+    "подожди минуту",
+    "мне нужно десять минут на душ",
+    "фильм идет два часа",
+    "включи музыку на 5 минут",
+])
+def test_duration_without_timer_word_is_not_timer(parser, text):
+
+    result = parse(parser, text)
+
+    assert not result or result[0].name != "set_timer"
+
+
+@pytest.mark.parametrize("text, name", [
+    ("который час", "get_time"),
+    ("какая погода сегодня", "get_weather"),
+    ("напомни мне позвонить маме через пять минут", "set_notification"),
+    ("позвони маме", "call_contact"),
+])
+def test_direct_commands(parser, text, name):
+
+    assert parse(parser, text)[0].name == name
+
+
+def test_timer_without_duration_goes_to_llm(parser):
+
+    assert parse(parser, "таймер") is None
+
+
+def test_call_without_contact_goes_to_llm(parser):
+
+    assert parse(parser, "позвони мне через пять минут") is None
+
+
+def test_call_drops_time_from_contact(parser):
+
+    assert parse(parser, "позвони маме через час")[0].args == {"contact_name": "маме"}
+
+
+@pytest.mark.parametrize("text", [
+    "напомни через 2 часа выпить таблетку",
+    "напомни через два часа выпить таблетку",
+])
+def test_notification_text_without_time(parser, text):
+
+    assert parse(parser, text)[0].args == {"hours": 2, "text": "выпить таблетку"}
+
+
+def test_defaults_outside_direct_parsing(parser):
+
+    assert parser._extract_args("set_timer", "таймер") == {"minutes": 1}
+    assert parser._extract_args("set_timer", "таймер", strict=True) is None
+
+
+def test_small_talk_goes_to_llm(parser):
+
+    assert parse(parser, "расскажи анекдот") is None
+
+
+def test_action_tag(parser):
+
+    result = parser._parse_action_tags("[таймер] 5 минут")
+
+    assert result[0].name == "set_timer"
+    assert result[0].args == {"minutes": 5}
+    assert parser._parse_action_tags("без тегов") is None
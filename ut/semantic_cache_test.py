@@ -0,0 +1,177 @@
+import asyncio
+import pytest
+import numpy as np
+
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import semantic_cache
+from semantic_cache import SemanticCache, is_contextual
+
+
+VECTORS = {
+    "какая погода": [1.0, 0.0, 0.0],
+    "какая сейчас погода": [0.99, 0.14, 0.0],
+    "который час": [0.0, 1.0, 0.0],
+    "включи музыку": [0.0, 0.0, 1.0],
+    "расскажи анекдот": [0.6, 0.6, 0.5],
+}
+
+
+class FakeModel:
+    """Эмбеддинги из таблицы вместо sentence-transformers"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, text, normalize_embeddings=True):
+        self.calls += 1
+        emb = np.asarray(VECTORS[text], dtype=np.float32)
+        return emb / np.linalg.norm(emb)
+
+
+@pytest.fixture
+def cache():
+
+    cache = SemanticCache("fake", threshold=0.9, maxsize=2)
+    cache.model = FakeModel()
+    return cache
+
+
+def run(coro):
+
+    return asyncio.run(coro)
+
+
+def test_similar_phrase_hits(cache):
+
+    run(cache.add("какая погода", "солнечно"))
+
+    assert run(cache.lookup("какая сейчас погода")) == "солнечно"
+
+
+def test_different_phrase_misses(cache):
+
+    run(cache.add("какая погода", "солнечно"))
+
+    assert run(cache.lookup("который час")) is None
+
+
+def test_empty_cache_misses(cache):
+
+    assert run(cache.lookup("какая погода")) is None
+
+
+def test_namespaces_do_not_mix(cache):
+
+    run(cache.add("какая погода", "солнечно", namespace="prompt-a"))
+
+    assert run(cache.lookup("какая погода", namespace="prompt-b")) is None
+    assert run(cache.lookup("какая погода", namespace="prompt-a")) == "солнечно"
+
+
+def test_least_recently_used_entry_is_evicted(cache):
+
+    run(cache.add("какая погода", "солнечно"))
+    run(cache.add("который час", "полдень"))
+    run(cache.lookup("какая погода"))
+    run(cache.add("включи музыку", "включаю"))
+
+    assert run(cache.lookup("какая погода")) == "солнечно"
+    assert run(cache.lookup("который час")) is None
+    assert run(cache.lookup("включи музыку")) == "включаю"
+
+
+def test_similar_phrase_replaces_entry(cache):
+
+    run(cache.add("какая погода", "солнечно"))
+    run(cache.add("какая сейчас погода", "дождь"))
+
+    assert cache.size == 1
+    assert run(cache.lookup("какая погода")) == "дождь"
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    clock = Clock()
+    monkeypatch.setattr(semantic_cache.time, "monotonic", clock)
+    return clock
+
+
+def test_entry_expires_after_ttl(cache, clock):
+
+    cache.ttl = 60
+    run(cache.add("какая погода", "солнечно"))
+    clock.now += 59
+    assert run(cache.lookup("какая погода")) == "солнечно"
+
+    clock.now += 2
+    assert run(cache.lookup("какая погода")) is None
+
+
+def test_expired_phrase_reuses_its_slot(cache, clock):
+
+    cache.ttl = 60
+    run(cache.add("какая погода", "солнечно"))
+    clock.now += 61
+    run(cache.add("какая погода", "дождь"))
+
+    assert cache.size == 1
+    assert run(cache.lookup("какая погода")) == "дождь"
+
+
+def test_expired_entry_is_evicted_first(cache, clock):
+
+    cache.ttl = 60
+    run(cache.add("какая погода", "солнечно"))
+    clock.now += 30
+    run(cache.add("который час", "полдень"))
+    run(cache.lookup("какая погода"))  # по LRU вытеснялся бы "который час"
+    clock.now += 31
+    run(cache.add("включи музыку", "включаю"))
+
+    assert run(cache.lookup("который час")) == "полдень"
+    assert run(cache.lookup("включи музыку")) == "включаю"
+
+
+def test_embedding_is_computed_once(cache):
+
+    run(cache.lookup("какая погода"))
+    run(cache.add("какая погода", "солнечно"))
+    run(cache.lookup("какая погода"))
+
+    assert cache.model.calls == 1
+
+
+def test_contextual_phrase_is_not_cached(cache):
+
+    run(cache.add("выключи его", "выключаю"))
+
+    assert cache.size == 0
+    assert run(cache.lookup("выключи его")) is None
+    assert cache.model.calls == 0
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("выключи его", True),
+    ("а там что", True),
+    ("повтори ещё раз", True),
+    ("какая погода", False),
+    ("включи музыку", False),
+    ("который час", False),
+])
+def test_is_contextual(text, expected):
+
+    assert is_contextual(text) is expected
@@ -1,6 +1,8 @@
 import asyncio
+import logging
 import os
-import json
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 import websockets
 from vosk import Model, KaldiRecognizer
 from typing import Optional
@@ -10,17 +12,31 @@ import webrtcvad
 
 load_dotenv()
 
+# Отладочный вывод VAD по каждому запросу включается через LOG_LEVEL=DEBUG
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="[%(levelname)s] %(message)s")
+log = logging.getLogger(__name__)
+
 # Настройки WebSocket сервера
 STT_WS_HOST = os.getenv("STT_WS_HOST", "0.0.0.0")
 STT_WS_PORT = int(os.getenv("STT_WS_PORT", 8778))
 
 # Путь к модели Vosk
 VOSK_MODEL_PATH = os.getenv("VOSK_MODEL_PATH", "models/vosk-model-small-ru-0.22")
+# Необязательная грамматика - JSON-список фраз, например '["который час", "какая погода", "[unk]"]'.
+# Поиск идет только по этим словам, это быстрее, но свободный текст (имена, напоминания) теряется.
+# Поддерживается small-моделями Vosk
+VOSK_GRAMMAR = os.getenv("VOSK_GRAMMAR")
 
 # Энергетический порог и минимальная длительность речи (сек)
 ENERGY_THRESHOLD = float(os.getenv("ENERGY_THRESHOLD", "0.005"))
 MIN_SPEECH_DURATION = float(os.getenv("MIN_SPEECH_DURATION", "0.3"))
 PCM_SAMPLE_RATE = int(os.getenv("PCM_SAMPLE_RATE", 16000))
+# Аудио подается в распознаватель порциями: Kaldi переводит каждую порцию во float,
+# поэтому пиковая память не зависит от длины фразы. 8000 байт = 250 мс при 16 кГц int16
+VOSK_CHUNK_BYTES = int(os.getenv("VOSK_CHUNK_BYTES", "8000"))
+# Декодирование Kaldi идет в потоках (cffi отпускает GIL): соединения пула агента распознаются
+# параллельно, а event loop продолжает принимать аудио
+decode_pool = ThreadPoolExecutor(max_workers=int(os.getenv("STT_THREADS", os.cpu_count() or 2)), thread_name_prefix="vosk")
 
 # --- Глобальная загрузка модели Vosk (один раз) ---
 model = Model(VOSK_MODEL_PATH)
@@ -28,6 +44,7 @@ model = Model(VOSK_MODEL_PATH)
 # --- WebRTC-VAD ---
 vad = webrtcvad.Vad(2)  # 0-3, где 3 — самая агрессивная фильтрация
 VAD_FRAME_MS = 30  # длина одного фрейма для VAD (10, 20 или 30 мс)
+MIN_SPEECH_FRAMES = max(1, int(0.3 * 1000 / VAD_FRAME_MS))  # минимум 0.3 сек речи
 
 # Класс для аудиосообщений
 class AudioMsg:
@@ -39,21 +56,29 @@ class AudioMsg:
 def detect_speech(audio_bytes: bytes, sample_rate: int) -> bool:
     # WebRTC-VAD работает с 16-бит PCM, 8/16/32 кГц, моно
     frame_size = int(sample_rate * VAD_FRAME_MS / 1000) * 2  # 2 байта на сэмпл
-    num_frames = len(audio_bytes) // frame_size
     speech_frames = 0
-    for i in range(num_frames):
-        start = i * frame_size
-        end = start + frame_size
-        frame = audio_bytes[start:end]
-        if len(frame) < frame_size:
-            break
-        if vad.is_speech(frame, sample_rate):
+    # Шаг по целым фреймам; неполный хвост не проверяется.
+    # Как только набрано достаточно речи, остальное аудио не сканируем.
+    for start in range(0, len(audio_bytes) - frame_size + 1, frame_size):
+        if vad.is_speech(audio_bytes[start:start + frame_size], sample_rate):
             speech_frames += 1
-    min_speech_frames = max(1, int(0.3 * 1000 / VAD_FRAME_MS))  # минимум 0.3 сек речи
-    has_speech = speech_frames >= min_speech_frames
-    print(f"[VAD] Speech frames: {speech_frames}, Min required: {min_speech_frames}, Has speech: {has_speech}")
+            if speech_frames >= MIN_SPEECH_FRAMES:
+                break
+    has_speech = speech_frames >= MIN_SPEECH_FRAMES
+    log.debug("[VAD] Speech frames: %d, Min required: %d, Has speech: %s", speech_frames, MIN_SPEECH_FRAMES, has_speech)
     return has_speech
 
+def recognize(raw: bytes, sample_rate: int) -> str:
+    """Распознает PCM по порциям; распознаватель новый на каждую фразу, модель общая"""
+    rec = KaldiRecognizer(model, sample_rate, VOSK_GRAMMAR) if VOSK_GRAMMAR else KaldiRecognizer(model, sample_rate)
+    texts = []
+    for start in range(0, len(raw), VOSK_CHUNK_BYTES):
+        # True - Vosk нашел паузу и закрыл сегмент: забираем его, иначе FinalResult вернет только последний
+        if rec.AcceptWaveform(bytes(raw[start:start + VOSK_CHUNK_BYTES])):
+            texts.append(orjson.loads(rec.Result()).get("text", ""))
+    texts.append(orjson.loads(rec.FinalResult()).get("text", ""))
+    return " ".join(t for t in texts if t)
+
 # Функция распознавания речи через Vosk
 async def stt_vosk(audio: AudioMsg) -> str:
     """
@@ -63,16 +88,7 @@ async def stt_vosk(audio: AudioMsg) -> str:
     # VAD: Проверяем, содержит ли аудио речь
     if not detect_speech(audio.raw, audio.sr):
         return "Не удалось распознать речь"
-    # Используем глобальную модель
-    rec = KaldiRecognizer(model, audio.sr)
-    
-    # Обрабатываем аудиоданные
-    rec.AcceptWaveform(audio.raw)
-    result = rec.FinalResult()
-    
-    # Парсим результат
-    result_json = json.loads(result)
-    recognized_text = result_json.get("text", "")
+    recognized_text = await asyncio.get_running_loop().run_in_executor(decode_pool, recognize, audio.raw, audio.sr)
     
     # Если текст пустой, возвращаем сообщение об ошибке
     if not recognized_text:
@@ -107,6 +123,7 @@ async def main_ws():
         STT_WS_HOST, 
         STT_WS_PORT, 
         max_size=8*2**20, 
+        compression=None,    # аудио не сжимается deflate
         ping_interval=300,   # 5 минут
         ping_timeout=None):  # Без таймаута
         await asyncio.Future()  # run forever
@@ -125,6 +142,12 @@ async def test_stt(pcm_file_path: str):
 # Запуск как основной скрипт
 if __name__ == "__main__":
     import sys
+    # uvloop, если установлен
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     if len(sys.argv) > 1:
         if sys.argv[1] == "ws":
             # Запуск WebSocket сервера